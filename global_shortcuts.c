@@ -1,107 +1,261 @@
-#include <stdio.h>
 #include <Python.h>
 #include <X11/Xlib.h>
 #include <X11/Xutil.h>
 
+/* Modifiers that are part of a shortcut; others (Lock, NumLock) are ignored */
+#define SHORTCUT_MASK (ShiftMask | ControlMask | Mod1Mask | Mod4Mask)
+#define MAX_KEYCODES 256
+
 typedef struct {
-    int keysym;
-    char *keyname;
+    KeySym keysym;
+    unsigned int modifiers;
+    PyObject *action;
     unsigned int keycode;
-} keymap_t;
+    int next;  /* next binding with the same keycode, or -1 */
+} binding_t;
 
-PyObject *
-watch_shortcuts(PyObject *self, PyObject *callable)
+static const unsigned int ignored_modifiers[] = {
+    0, LockMask, Mod2Mask, LockMask | Mod2Mask,
+};
+#define N_IGNORED (sizeof(ignored_modifiers) / sizeof(*ignored_modifiers))
+
+static binding_t *bindings = NULL;
+static Py_ssize_t n_bindings = 0;
+/* First binding for each keycode, or -1 */
+static int by_keycode[MAX_KEYCODES];
+
+static Display *dpy = NULL;
+static PyObject *callback = NULL;
+
+static void
+grab_keys(void)
 {
-    Display*    dpy     = XOpenDisplay(0);
-    Window      root    = DefaultRootWindow(dpy);
-    XEvent      ev;
-
-    unsigned int    modifiers       = ControlMask | ShiftMask | Mod1Mask | Mod4Mask;
-    Window          grab_window     =  root;
-    Bool            owner_events    = False;
-    int             pointer_mode    = GrabModeAsync;
-    int             keyboard_mode   = GrabModeAsync;
-
-    keymap_t keymap[] = {
-        {XK_1, "1", 0},
-        {XK_2, "2", 0},
-        {XK_3, "3", 0},
-        {XK_4, "4", 0},
-        {XK_5, "5", 0},
-        {XK_6, "6", 0},
-        {XK_M, "M", 0},
-        {XK_H, "H", 0},
-        {XK_E, "E", 0},
-        {XK_Q, "Q", 0},
-        {XK_Z, "Z", 0},
-        {XK_Y, "Y", 0},
-        {XK_D, "D", 0},
-        {XK_Escape, "Esc", 0},
-        {0, 0, 0}
-    };
-
-    for (int i=0; keymap[i].keysym; i++) {
-        unsigned int keycode = XKeysymToKeycode(dpy, keymap[i].keysym);
-        keymap[i].keycode = keycode;
-        XGrabKey(
-            dpy, keycode, modifiers, grab_window, owner_events, pointer_mode,
-            keyboard_mode
-        );
+    Window root = DefaultRootWindow(dpy);
+    for (int i=0; i<MAX_KEYCODES; i++) {
+        by_keycode[i] = -1;
+    }
+    for (Py_ssize_t i=n_bindings-1; i>=0; i--) {
+        binding_t *b = &bindings[i];
+        b->keycode = XKeysymToKeycode(dpy, b->keysym);
+        if (b->keycode == 0 || b->keycode >= MAX_KEYCODES) {
+            continue;
+        }
+        b->next = by_keycode[b->keycode];
+        by_keycode[b->keycode] = i;
+        for (size_t j=0; j<N_IGNORED; j++) {
+            XGrabKey(
+                dpy, b->keycode, b->modifiers | ignored_modifiers[j], root,
+                False, GrabModeAsync, GrabModeAsync
+            );
+        }
     }
+    XFlush(dpy);
+}
 
-    while(1)
-    {
-        int shouldQuit = 0;
-        Py_BEGIN_ALLOW_THREADS;
-        XNextEvent(dpy, &ev);
-        Py_END_ALLOW_THREADS;
-        switch(ev.type)
-        {
-            case KeyPress:
-                for (int i=0; keymap[i].keysym; i++) {
-                    printf("Trying hot key %d...\n", i);
-                    if (keymap[i].keycode == ev.xkey.keycode) {
-                        printf("Hot key %d pressed!\n", i);
-                        PyObject *name = PyUnicode_FromString(keymap[i].keyname);
-                        if (name == NULL) {
-                            shouldQuit = 1;
-                            break;
-                        }
-                        PyObject *result = PyObject_CallOneArg(callable, name);
-                        Py_XDECREF(name);
-                        if (result == NULL) {
-                            shouldQuit = 1;
-                            break;
-                        }
-                        Py_XDECREF(result);
-                        break;
-                    }
-                }
-                break;
+static void
+ungrab_keys(void)
+{
+    Window root = DefaultRootWindow(dpy);
+    for (Py_ssize_t i=0; i<n_bindings; i++) {
+        binding_t *b = &bindings[i];
+        if (b->keycode == 0 || b->keycode >= MAX_KEYCODES) {
+            continue;
+        }
+        for (size_t j=0; j<N_IGNORED; j++) {
+            XUngrabKey(
+                dpy, b->keycode, b->modifiers | ignored_modifiers[j], root
+            );
+        }
+    }
+}
 
-            default:
-                break;
+static void
+clear_bindings(void)
+{
+    for (Py_ssize_t i=0; i<n_bindings; i++) {
+        Py_DECREF(bindings[i].action);
+    }
+    PyMem_Free(bindings);
+    bindings = NULL;
+    n_bindings = 0;
+}
+
+static PyObject *
+shortcuts_disconnect(PyObject *self, PyObject *unused)
+{
+    if (dpy) {
+        ungrab_keys();
+        XCloseDisplay(dpy);
+        dpy = NULL;
+    }
+    clear_bindings();
+    Py_CLEAR(callback);
+    Py_RETURN_NONE;
+}
+
+static int
+parse_keymap(PyObject *keymap)
+{
+    PyObject *seq = PySequence_Fast(keymap, "keymap must be a sequence");
+    if (seq == NULL) {
+        return -1;
+    }
+    Py_ssize_t size = PySequence_Fast_GET_SIZE(seq);
+    bindings = PyMem_Calloc(size ? size : 1, sizeof(binding_t));
+    if (bindings == NULL) {
+        Py_DECREF(seq);
+        PyErr_NoMemory();
+        return -1;
+    }
+    for (Py_ssize_t i=0; i<size; i++) {
+        const char *name;
+        unsigned int modifiers;
+        PyObject *action;
+        PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyTuple_Check(item)) {
+            PyErr_SetString(
+                PyExc_TypeError,
+                "keymap items must be (keysym, modifiers, action) tuples"
+            );
+            goto error;
+        }
+        if (!PyArg_ParseTuple(item, "sIO", &name, &modifiers, &action)) {
+            goto error;
+        }
+        KeySym keysym = XStringToKeysym(name);
+        if (keysym == NoSymbol) {
+            PyErr_Format(PyExc_ValueError, "unknown keysym: %s", name);
+            goto error;
         }
+        if (modifiers & ~SHORTCUT_MASK) {
+            PyErr_Format(PyExc_ValueError, "bad modifiers for %s", name);
+            goto error;
+        }
+        Py_INCREF(action);
+        bindings[i] = (binding_t){keysym, modifiers, action, 0, -1};
+        n_bindings = i + 1;
+    }
+    Py_DECREF(seq);
+    return 0;
+error:
+    Py_DECREF(seq);
+    clear_bindings();
+    return -1;
+}
 
-        if(shouldQuit)
-            break;
+static PyObject *
+shortcuts_connect(PyObject *self, PyObject *args)
+{
+    PyObject *keymap, *callable;
+    if (!PyArg_ParseTuple(args, "OO:connect", &keymap, &callable)) {
+        return NULL;
     }
+    if (!PyCallable_Check(callable)) {
+        PyErr_SetString(PyExc_TypeError, "callback must be callable");
+        return NULL;
+    }
+    PyObject *result = shortcuts_disconnect(self, NULL);
+    Py_DECREF(result);
+    if (parse_keymap(keymap) < 0) {
+        return NULL;
+    }
+    dpy = XOpenDisplay(0);
+    if (dpy == NULL) {
+        clear_bindings();
+        PyErr_SetString(PyExc_OSError, "cannot open X display");
+        return NULL;
+    }
+    grab_keys();
+    Py_INCREF(callable);
+    callback = callable;
+    return PyLong_FromLong(ConnectionNumber(dpy));
+}
 
-    XCloseDisplay(dpy);
+static PyObject *
+shortcuts_process_events(PyObject *self, PyObject *unused)
+{
+    XEvent ev;
+    PyObject *type = NULL, *value = NULL, *traceback = NULL;
 
-    return NULL;
+    /* Events are drained even if the callback raises, as the socket
+       notifier won't fire again for the ones Xlib has already read.
+       The first error is raised at the end; later ones are reported
+       as unraisable. */
+    while (dpy && XPending(dpy)) {
+        XNextEvent(dpy, &ev);
+        if (ev.type == MappingNotify) {
+            if (ev.xmapping.request != MappingPointer) {
+                XRefreshKeyboardMapping(&ev.xmapping);
+                ungrab_keys();
+                grab_keys();
+            }
+            continue;
+        }
+        if (ev.type != KeyPress || ev.xkey.keycode >= MAX_KEYCODES) {
+            continue;
+        }
+        unsigned int state = ev.xkey.state & SHORTCUT_MASK;
+        for (int i=by_keycode[ev.xkey.keycode]; i>=0; i=bindings[i].next) {
+            if (bindings[i].modifiers == state) {
+                PyObject *result = PyObject_CallOneArg(
+                    callback, bindings[i].action
+                );
+                if (result == NULL) {
+                    if (type == NULL) {
+                        PyErr_Fetch(&type, &value, &traceback);
+                    }
+                    else {
+                        PyErr_WriteUnraisable(callback);
+                    }
+                }
+                Py_XDECREF(result);
+                break;
+            }
+        }
+    }
+    if (type != NULL) {
+        PyErr_Restore(type, value, traceback);
+        return NULL;
+    }
     Py_RETURN_NONE;
 }
 
 PyMethodDef methods[] = {
-    {"watch_shortcuts", watch_shortcuts, METH_O, NULL},
+    {"connect", shortcuts_connect, METH_VARARGS,
+     "connect(keymap, callback)\n\n"
+     "Grab the keys in keymap, a sequence of (keysym name, modifiers, action)\n"
+     "tuples, and return the X connection's file descriptor.\n"
+     "callback is called with the action of each pressed shortcut."},
+    {"process_events", shortcuts_process_events, METH_NOARGS,
+     "Call the callback for each pending shortcut, without blocking"},
+    {"disconnect", shortcuts_disconnect, METH_NOARGS,
+     "Release the shortcut keys and close the X connection"},
     {NULL},
 };
 
+static int
+module_exec(PyObject *module)
+{
+    if (PyModule_AddIntConstant(module, "SHIFT", ShiftMask) < 0
+        || PyModule_AddIntConstant(module, "CONTROL", ControlMask) < 0
+        || PyModule_AddIntConstant(module, "ALT", Mod1Mask) < 0
+        || PyModule_AddIntConstant(module, "SUPER", Mod4Mask) < 0)
+    {
+        return -1;
+    }
+    return 0;
+}
+
+static PyModuleDef_Slot slots[] = {
+    {Py_mod_exec, module_exec},
+    {0, NULL},
+};
+
 PyModuleDef mod = {
     .m_base = PyModuleDef_HEAD_INIT,
     .m_name = "global_shortcuts",
     .m_methods = methods,
+    .m_slots = slots,
 };
 
 PyObject *
@@ -1,23 +1,49 @@
 import sys
+import os
+import json
+import math
+import argparse
 import contextlib
+import collections
+import array
+import mmap
+import struct
+import zlib
+import signal
 import time
+import itertools
 import threading
+import queue
+import functools
 
+import numpy as np
 from PySide6.QtWidgets import QApplication, QWidget, QToolButton, QSizePolicy
 from PySide6.QtWidgets import QUndoView, QHBoxLayout, QVBoxLayout, QListView
-from PySide6.QtWidgets import QMainWindow
-from PySide6.QtGui import QPainter, QColor, QPixmap, QPen, QTabletEvent
+from PySide6.QtWidgets import QMainWindow, QPlainTextEdit, QFileDialog
+from PySide6.QtGui import QPainter, QColor, QPixmap, QTabletEvent
 from PySide6.QtGui import QPainterPath, QCursor, QBitmap, QIcon, QAction
 from PySide6.QtGui import QUndoStack, QUndoCommand, QStandardItemModel
 from PySide6.QtGui import QStandardItem, QUndoGroup, QPointingDevice
-from PySide6.QtGui import QKeyEvent
+from PySide6.QtGui import QKeyEvent, QRegion, QPolygonF, QImage
+from PySide6.QtGui import QPdfWriter, QPageSize
 from PySide6.QtCore import Qt, QEvent, QRect, QTimer, QFile, QObject, QSize
+from PySide6.QtCore import QPoint, QSocketNotifier, QMarginsF
 from PySide6.QtCore import Signal, QPointF, QRectF, QSizeF, QItemSelectionModel
-from PySide6.QtUiTools import QUiLoader
 
 import global_shortcuts
 
 MAX_RADIUS = 100
+CAP_STEPS = 8
+FRAME_MS = 1000 // 60
+WET_MS = 1000 // 30
+WET_SECONDS = 1
+WET_FADE = 0.9 ** 30  # opacity left after a second of drying
+PREDICT_SAMPLES = 4  # recent samples the pen velocity is taken from
+# Stored strokes leave out samples that are within this many pixels of the
+# outline drawn without them, looking at most this many samples back
+SIMPLIFY_TOLERANCE = 0.25
+SIMPLIFY_SAMPLES = 32
+STATS_MS = 1000
 
 COLORS = {
     'Red': (1, 0, 0),
@@ -28,144 +54,1240 @@ COLORS = {
     'Cyan': (0, 1, 1),
 }
 
+TILE_SIZE = 256
+TILE_BYTES = TILE_SIZE * TILE_SIZE * 4
+# Tiles are QImages rather than QPixmaps when rendering off the GUI thread
+TILE_IMAGES = False
+
+# Every KEYFRAME_INTERVAL-th scribble keeps its composited `final`;
+# others are rebuilt from the nearest keyframe by replaying scribbles.
+# Finals of all pictures share one FinalCache of FINAL_CACHE_BYTES.
+KEYFRAME_INTERVAL = 16
+FINAL_CACHE_BYTES = 256 * 1024 * 1024
+# Scribbles' own tiles are a cache of their strokes; the least recently
+# used are dropped beyond RASTER_CACHE_BYTES
+RASTER_CACHE_BYTES = 128 * 1024 * 1024
+
+# Cells of the StrokeIndex grid used to find strokes to erase
+GRID_SIZE = 64
+
+# Picture list icons shrink each tile to THUMBNAIL_TILE pixels, and are
+# redrawn at most every THUMBNAIL_MS
+THUMBNAIL_TILE = 8
+THUMBNAIL_MS = 250
+
+# Pictures other than the RESIDENT_PICTURES most recently shown lose
+# their finals, and their strokes move to a SpillFile
+RESIDENT_PICTURES = 4
+SPILL_CHUNK_BYTES = 64 * 1024 * 1024
+
+# Trace levels, and the categories that can be enabled with --trace
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100
+TRACE_LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'off': OFF}
+TRACE_CATEGORIES = ('input', 'paint', 'undo', 'shortcuts')
+TRACE_RING_RECORDS = 64 * 1024
+
+class Tracer:
+    # Each category attribute holds the lowest level traced for it, so a
+    # hot trace point can be skipped with `if TRACE.paint <= DEBUG`.
+    # Events go to stderr as text, or to a ring buffer of binary records
+    # (time, category, level, event name, 4 numbers) that is dumped on
+    # SIGUSR1 and at exit.
+    record = struct.Struct('<dBBH4d')
+    magic = b'pointout-trace\n'
+
+    def __init__(self):
+        for category in TRACE_CATEGORIES:
+            setattr(self, category, OFF)
+        self.names = {}
+        self.ring = None
+        self.count = 0
+        self.stream = sys.stderr
+
+    def configure(self, spec):
+        # spec is like 'input:info,paint' or 'all:debug'
+        for item in spec.split(','):
+            category, sep, level = item.partition(':')
+            level = TRACE_LEVELS[level or 'debug']
+            if category == 'all':
+                for category in TRACE_CATEGORIES:
+                    setattr(self, category, level)
+            elif category in TRACE_CATEGORIES:
+                setattr(self, category, level)
+            else:
+                raise ValueError(f'unknown trace category: {category}')
+
+    def use_ring(self, records=TRACE_RING_RECORDS):
+        self.ring = bytearray(records * self.record.size)
+        self.count = 0
+
+    def __call__(self, category, level, event, *values):
+        if level < getattr(self, category):
+            return
+        now = time.monotonic()
+        if self.ring is None:
+            print(f'{now:.6f} {category} {event}', *values, file=self.stream)
+            return
+        name = self.names.setdefault(event, len(self.names))
+        values = (values + (0, 0, 0, 0))[:4]
+        offset = self.count * self.record.size % len(self.ring)
+        self.record.pack_into(
+            self.ring, offset,
+            now, TRACE_CATEGORIES.index(category), level, name, *values,
+        )
+        self.count += 1
+
+    def dump(self, file):
+        used = self.count * self.record.size
+        if used > len(self.ring):
+            start = used % len(self.ring)
+            data = self.ring[start:] + self.ring[:start]
+        else:
+            data = self.ring[:used]
+        file.write(self.magic)
+        file.write(json.dumps({
+            'categories': TRACE_CATEGORIES,
+            'names': sorted(self.names, key=self.names.get),
+            'records': len(data) // self.record.size,
+        }).encode() + b'\n')
+        file.write(data)
+
+def read_trace(file):
+    if file.readline() != Tracer.magic:
+        raise ValueError('not a pointout trace')
+    header = json.loads(file.readline())
+    categories, names = header['categories'], header['names']
+    for i in range(header['records']):
+        now, category, level, name, *values = Tracer.record.unpack(
+            file.read(Tracer.record.size),
+        )
+        yield now, categories[category], level, names[name], values
+
+TRACE = Tracer()
+
+class Histogram:
+    # Counts of values in power-of-two buckets: bucket n holds values
+    # in [2**(n-1), 2**n), so percentiles are upper bounds within 2x
+    def __init__(self, unit):
+        self.unit = unit
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[int(max(value, 0)).bit_length()] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= self.count * fraction:
+                return min(2 ** bucket, self.max)
+        return 0
+
+    def to_dict(self):
+        return {
+            'unit': self.unit,
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': self.max,
+            'buckets': {
+                2 ** bucket: n for bucket, n in sorted(self.buckets.items())
+            },
+        }
+
+class Stats:
+    # Histograms of timings and sizes, filled from both the GUI and
+    # render threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {
+            'frame_us': Histogram('us'),
+            'paint_us': Histogram('us'),
+            'anim_us': Histogram('us'),
+            'tool_paint_us': Histogram('us'),
+            'final_us': Histogram('us'),
+            'input_latency_us': Histogram('us'),
+            'dirty_px': Histogram('px'),
+        }
+
+    def add(self, name, value):
+        with self.lock:
+            self.histograms[name].add(value)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        yield
+        self.add(name, (time.perf_counter() - start) * 1e6)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                name: histogram.to_dict()
+                for name, histogram in self.histograms.items()
+            }
+
+STATS = Stats()
+
+def tile_keys(rect):
+    for ty in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1):
+        for tx in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1):
+            yield tx, ty
+
+def tile_rect(key):
+    tx, ty = key
+    return QRect(tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+
+def thumbnail_size(size):
+    return QSize(
+        -(-size.width() * THUMBNAIL_TILE // TILE_SIZE),
+        -(-size.height() * THUMBNAIL_TILE // TILE_SIZE),
+    )
+
+def new_tile():
+    if TILE_IMAGES:
+        tile = QImage(TILE_SIZE, TILE_SIZE, QImage.Format_ARGB32_Premultiplied)
+    else:
+        tile = QPixmap(TILE_SIZE, TILE_SIZE)
+    tile.fill(QColor(0, 0, 0, 0))
+    return tile
+
+def draw_tile(painter, target, tile, *source):
+    if isinstance(tile, QImage):
+        painter.drawImage(target, tile, *source)
+    else:
+        painter.drawPixmap(target, tile, *source)
+
+
+class MultiPainter:
+    def __init__(self, painters):
+        self.painters = painters
+
+    def __getattr__(self, name):
+        def func(*args):
+            for painter in self.painters:
+                getattr(painter, name)(*args)
+        return func
+
+
+class FinalCache:
+    def __init__(self, max_bytes=FINAL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.tile_refs = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return (
+            f'<FinalCache {len(self.entries)} finals, {self.nbytes} bytes, '
+            + f'{self.hits} hits, {self.misses} misses, '
+            + f'{self.evictions} evictions>'
+        )
+
+    @property
+    def nbytes(self):
+        # Finals share most of their tiles, so count each tile once
+        return len(self.tile_refs) * TILE_BYTES
+
+    def add(self, overlay):
+        self.discard(overlay)
+        tile_ids = [id(t) for t in overlay._final.tiles.values()]
+        self.entries[overlay] = tile_ids
+        self.tile_refs.update(tile_ids)
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            victim = next(iter(self.entries))
+            victim.forget_final()
+            self.evictions += 1
+
+    def touch(self, overlay):
+        if overlay in self.entries:
+            self.entries.move_to_end(overlay)
+
+    def discard(self, overlay):
+        tile_ids = self.entries.pop(overlay, ())
+        for tile_id in tile_ids:
+            self.tile_refs[tile_id] -= 1
+            if not self.tile_refs[tile_id]:
+                del self.tile_refs[tile_id]
+
+
+class RasterCache:
+    # Scribbles holding rasters of their strokes, least recently used first
+    def __init__(self, max_bytes=RASTER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return (
+            f'<RasterCache {len(self.entries)} rasters, {self.nbytes} bytes, '
+            + f'{self.evictions} evictions>'
+        )
+
+    def add(self, overlay):
+        self.nbytes += overlay.nbytes - self.entries.pop(overlay, 0)
+        self.entries[overlay] = overlay.nbytes
+        # The newest raster may be one that's being drawn into; keep it
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            victim = next(iter(self.entries))
+            victim.drop_raster()
+            self.evictions += 1
+
+    def touch(self, overlay):
+        if overlay in self.entries:
+            self.entries.move_to_end(overlay)
+
+    def discard(self, overlay):
+        self.nbytes -= self.entries.pop(overlay, 0)
+
+
+def stroke_outline(xy, radii):
+    # Outline of a variable-width stroke with round caps, as an (n, 2) array
+    keep = np.ones(len(xy), dtype=bool)
+    keep[1:] = np.any(np.diff(xy, axis=0) != 0, axis=1)
+    xy = xy[keep]
+    radii = radii[keep]
+    cap = np.linspace(0, np.pi, CAP_STEPS)
+    if len(xy) == 1:
+        angles = np.linspace(0, 2 * np.pi, CAP_STEPS * 2, endpoint=False)
+        circle = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        return xy[0] + circle * radii[0]
+    tangents = np.diff(xy, axis=0)
+    tangents /= np.hypot(tangents[:, 0], tangents[:, 1])[:, None]
+    seg_normals = np.stack([-tangents[:, 1], tangents[:, 0]], axis=1)
+    normals = np.empty_like(xy)
+    normals[0] = seg_normals[0]
+    normals[-1] = seg_normals[-1]
+    joins = seg_normals[:-1] + seg_normals[1:]
+    lengths = np.hypot(joins[:, 0], joins[:, 1])
+    lengths[lengths == 0] = 1
+    joins /= lengths[:, None]
+    # Lengthen the offset at joins so segments keep their width,
+    # but limit it like a miter limit for sharp turns
+    miter = np.maximum(np.sum(joins * seg_normals[1:], axis=1), 0.5)
+    normals[1:-1] = joins / miter[:, None]
+    left = xy + normals * radii[:, None]
+    right = xy - normals * radii[:, None]
+
+    def round_cap(center, radius, normal, start_angle):
+        angles = np.arctan2(normal[1], normal[0]) + start_angle - cap
+        return center + radius * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+    return np.concatenate([
+        left,
+        round_cap(xy[-1], radii[-1], normals[-1], 0),
+        right[::-1],
+        round_cap(xy[0], radii[0], normals[0], np.pi),
+    ])
+
+
+STROKE_FIELDS = 5  # x, y, pressure, time, tool id
+
+class Stroke:
+    # Samples are simplified as they come in: `points` holds the ones that
+    # are kept, `tail` the ones after the last of those, which are
+    # dropped as soon as a later sample shows the line through them is
+    # near enough straight. Ink is drawn from the raw samples in `fresh`.
+    def __init__(self):
+        self.points = array.array('d')
+        self.tail = array.array('d')
+        self.fresh = array.array('d')
+        self.start_time = time.monotonic()
+        self.rendered = False
+
+    def __len__(self):
+        return (len(self.points) + len(self.tail)) // STROKE_FIELDS
+
+    def __repr__(self):
+        return f'<Stroke {len(self)} points>'
+
+    @property
+    def nbytes(self):
+        return (len(self.points) + len(self.tail)) * self.points.itemsize
+
+    @property
+    def committed(self):
+        # Number of samples that simplification won't change any more
+        return len(self.points) // STROKE_FIELDS
+
+    def append(self, pos, pressure, tool, t=None):
+        if t is None:
+            t = time.monotonic()
+        if not isinstance(self.points, array.array):
+            self.points = array.array('d', self.points)  # spilled
+        sample = (pos.x(), pos.y(), pressure, t - self.start_time, tool.id)
+        self.fresh.extend(sample)
+        if len(self.points) < 2 * STROKE_FIELDS:
+            # Keep the press and the sample that gives it its pressure
+            self.points.extend(sample)
+            return
+        if self.tail and not self.fits(sample, tool):
+            self.points.extend(self.tail[-STROKE_FIELDS:])
+            del self.tail[:]
+        self.tail.extend(sample)
+
+    def fits(self, sample, tool):
+        # Whether the samples in `tail` can be left out of the line from
+        # the last kept sample to `sample`
+        tail = np.array(self.tail).reshape(-1, STROKE_FIELDS)
+        if len(tail) >= SIMPLIFY_SAMPLES or (tail[:, 4] != sample[4]).any():
+            return False
+        a = np.array(self.points[-STROKE_FIELDS:])
+        b = np.array(sample)
+        ab = b[:2] - a[:2]
+        u = np.clip(
+            ((tail[:, :2] - a[:2]) @ ab) / max(ab @ ab, 1e-9), 0, 1,
+        )
+        nearest = a[:2] + u[:, None] * ab
+        if (np.hypot(*(tail[:, :2] - nearest).T) > SIMPLIFY_TOLERANCE).any():
+            return False
+        # The outline's radius is pressure * scale / 2
+        pressure = a[2] + u * (b[2] - a[2])
+        error = np.abs(tail[:, 2] - pressure) * tool.scale / 2
+        return (error <= SIMPLIFY_TOLERANCE).all()
+
+    def finish(self):
+        # Keeps the last sample, when no more are coming
+        if self.tail:
+            self.points.extend(self.tail[-STROKE_FIELDS:])
+            del self.tail[:]
+
+    def samples(self, start=0, end=None):
+        # A copy, as spilled points are a view of the SpillFile
+        if end is None:
+            end = len(self)
+        points = self.points
+        if self.tail:
+            points = points + self.tail
+        return np.array(
+            points[start * STROKE_FIELDS:end * STROKE_FIELDS],
+            dtype=np.float64,
+        ).reshape(-1, STROKE_FIELDS)
+
+    def fresh_outlines(self):
+        # Outlines of the raw samples appended since the last call, joined
+        # to the one before them
+        samples = np.array(self.fresh).reshape(-1, STROKE_FIELDS)
+        if len(samples) < 2:
+            return []
+        del self.fresh[:-STROKE_FIELDS]
+        outlines = self.outlines(samples, joined=self.rendered)
+        self.rendered = True
+        return outlines
+
+    def mark_rendered(self, last):
+        # After the whole stroke was drawn up to the sample `last`, only
+        # later ones are fresh. On the GUI thread, which appends to fresh.
+        if last is not None:
+            fresh = np.array(self.fresh).reshape(-1, STROKE_FIELDS)
+            fresh = fresh[fresh[:, 3] > last[3]]
+            self.fresh = array.array('d', np.vstack([last, fresh]).ravel())
+            self.rendered = True
+
+    def outlines(self, samples=None, joined=False):
+        # Outlines of `samples` (all of them by default), as
+        # (tool, rect, color, polygon) per run of samples with one tool
+        if samples is None:
+            samples = self.samples()
+        if len(samples) < 2:
+            return []
+        if not joined:
+            # The press sample has no pressure of its own
+            samples[0, 2] = samples[1, 2]
+        tool_ids = samples[:, 4]
+        ends = [*(np.flatnonzero(np.diff(tool_ids)) + 1), len(samples)]
+        result = []
+        begin = 0
+        for end in ends:
+            tool = TOOLS[int(tool_ids[end - 1])]
+            result.append((tool, *tool.outline(samples[begin:end])))
+            begin = end - 1
+        return result
+
+    def rasterize(self, overlay, outlines=None):
+        if outlines is None:
+            outlines = self.outlines()
+        for tool, rect, color, polygon in outlines:
+            tool.paint(overlay, rect, color, polygon)
+
+
+class SpillFile:
+    # Stroke points of pictures that are not in use, in a temporary file.
+    # Strokes keep a view of their mapped points; pages are read back
+    # when the picture is drawn again.
+    def __init__(self):
+        import tempfile
+        self.file = tempfile.TemporaryFile(prefix='pointout-spill-')
+        self.size = 0
+        self.map = None
+        self.chunk = None
+        self.used = 0
+
+    def store(self, points):
+        if self.chunk is None or self.used + len(points) > len(self.chunk):
+            nbytes = max(SPILL_CHUNK_BYTES, len(points) * points.itemsize)
+            nbytes = -(-nbytes // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+            self.file.truncate(self.size + nbytes)
+            self.map = mmap.mmap(self.file.fileno(), nbytes, offset=self.size)
+            self.chunk = memoryview(self.map).cast('d')
+            self.size += nbytes
+            self.used = 0
+        view = self.chunk[self.used:self.used + len(points)]
+        view[:] = points
+        self.used += len(points)
+        return view
+
+    def page_out(self):
+        # Written pages are in the file; drop them from resident memory
+        if self.map is not None and hasattr(mmap, 'MADV_DONTNEED'):
+            self.map.madvise(mmap.MADV_DONTNEED)
+
+
+def stroke_radii(samples):
+    # Sample positions and outline radii, as Tool.outline draws them
+    scales = np.array([tool.scale for tool in TOOLS])
+    radii = np.maximum(samples[:, 2] * scales[samples[:, 4].astype(int)], 1) / 2
+    return samples[:, :2], radii
+
+
+def segment_distances(p0, p1, a, b):
+    # Distances between the segment p0-p1 and each segment a[i]-b[i]
+    def to_segments(point, a, b):
+        ab = b - a
+        t = np.clip(
+            ((point - a) * ab).sum(axis=1)
+            / np.maximum((ab * ab).sum(axis=1), 1e-9),
+            0, 1,
+        )
+        return np.hypot(*(a + ab * t[:, None] - point).T)
+    def to_segment(points, p0, p1):
+        return to_segments(points, p0[None], p1[None])
+    dist = np.minimum.reduce([
+        to_segments(p0, a, b), to_segments(p1, a, b),
+        to_segment(a, p0, p1), to_segment(b, p0, p1),
+    ])
+    def cross(o, u, v):
+        return (u[..., 0] - o[..., 0]) * (v[..., 1] - o[..., 1]) - (
+            (u[..., 1] - o[..., 1]) * (v[..., 0] - o[..., 0])
+        )
+    crossing = (
+        (np.sign(cross(p0, p1, a)) * np.sign(cross(p0, p1, b)) < 0)
+        & (np.sign(cross(a, b, p0)) * np.sign(cross(a, b, p1)) < 0)
+    )
+    dist[crossing] = 0
+    return dist
+
+
+class StrokeIndex:
+    # A grid of GRID_SIZE cells listing the scribbles whose stroke
+    # segments may touch each cell. Scribbles are indexed as they are
+    # finished or loaded (see add()); entries for scribbles no longer in
+    # the picture are skipped. `history` gives all scribbles that undo or
+    # redo could bring back.
+    def __init__(self, history):
+        self.history = history
+        self.cells = collections.defaultdict(list)
+        self.indexed = {}
+        self.geometry = {}
+        self.pending = set()
+
+    def add(self, scribble):
+        # Indexes the scribble's new samples at the next hit test
+        self.pending.add(scribble)
+
+    def update(self, scribbles):
+        if len(self.indexed) > 2 * len(scribbles) + 64:
+            # mostly removed scribbles; start over
+            self.cells.clear()
+            self.indexed.clear()
+            self.geometry.clear()
+            self.pending.update(self.history())
+        for scribble in self.pending:
+            done = self.indexed.get(scribble, 0)
+            if scribble.stroke.committed <= done:
+                continue
+            self.geometry[scribble] = stroke_radii(
+                scribble.stroke.samples(0, scribble.stroke.committed),
+            )
+            xy, radii = self.geometry[scribble]
+            xy, radii = xy[max(done - 1, 0):], radii[max(done - 1, 0):]
+            if len(xy) < 2:
+                continue
+            lo = np.minimum(xy[:-1], xy[1:]) - radii.max()
+            hi = np.maximum(xy[:-1], xy[1:]) + radii.max()
+            cell_lo = (lo // GRID_SIZE).astype(int).tolist()
+            cell_hi = (hi // GRID_SIZE).astype(int).tolist()
+            first = max(done - 1, 0)
+            for i, ((x0, y0), (x1, y1)) in enumerate(zip(cell_lo, cell_hi)):
+                for cx in range(x0, x1 + 1):
+                    for cy in range(y0, y1 + 1):
+                        self.cells[cx, cy].append((scribble, first + i))
+            self.indexed[scribble] = scribble.stroke.committed
+        self.pending.clear()
+
+    def hits(self, scribbles, start, end, radius):
+        # Scribbles in `scribbles` with a segment within `radius` of the
+        # segment from start to end
+        self.update(scribbles)
+        segments = collections.defaultdict(set)
+        for cx in range(
+            int((min(start.x(), end.x()) - radius) // GRID_SIZE),
+            int((max(start.x(), end.x()) + radius) // GRID_SIZE) + 1,
+        ):
+            for cy in range(
+                int((min(start.y(), end.y()) - radius) // GRID_SIZE),
+                int((max(start.y(), end.y()) + radius) // GRID_SIZE) + 1,
+            ):
+                for scribble, i in self.cells.get((cx, cy), ()):
+                    segments[scribble].add(i)
+        candidates = []
+        a, b, reach = [], [], []
+        for scribble, indices in segments.items():
+            if (
+                scribble.index >= len(scribbles)
+                or scribbles[scribble.index] is not scribble
+            ):
+                continue  # undone or erased
+            xy, radii = self.geometry[scribble]
+            i = np.array(list(indices))
+            candidates.append((scribble, len(i)))
+            a.append(xy[i])
+            b.append(xy[i + 1])
+            reach.append(np.maximum(radii[i], radii[i + 1]))
+        if not candidates:
+            return []
+        hit = segment_distances(
+            np.array([start.x(), start.y()]), np.array([end.x(), end.y()]),
+            np.concatenate(a), np.concatenate(b),
+        ) <= radius + np.concatenate(reach)
+        result = []
+        offset = 0
+        for scribble, count in candidates:
+            if hit[offset:offset + count].any():
+                result.append(scribble)
+            offset += count
+        return result
+
+
 class Overlay():
+    # A scribble's own tiles are its delta over `prev`. If it has a
+    # `stroke`, the tiles are only a raster cache of it and can be dropped.
+    # Tiles of `final` are never painted into once created, so the ones
+    # a scribble doesn't touch are shared with the previous `final`.
     composition_mode = QPainter.CompositionMode_SourceOver
     opacity = 0.5
     _final = None
-    def __init__(self, topleft=None, pixmap=None, prev=None):
-        self.pixmap = pixmap
+    def __init__(self, prev=None, cache=None, stroke=None, rasters=None):
+        self._tiles = {}
         self.prev = prev
-        if topleft and pixmap:
-            self.rect = QRect(
-                topleft.x(), topleft.y(),
-                pixmap.width(), pixmap.height()
-            )
+        self.cache = cache
+        self.stroke = stroke
+        self.rasters = rasters
+        self.rect = None
+        self._final_dirty = set()
+        if prev:
+            self.index = prev.index + 1
         else:
-            self.rect = None
+            self.index = 0
+
+    @property
+    def is_keyframe(self):
+        return self.index % KEYFRAME_INTERVAL == 0
+
+    @property
+    def nbytes(self):
+        if self._tiles is None:
+            return 0
+        return len(self._tiles) * TILE_BYTES
+
+    def forget_final(self):
+        self._final = None
+        if self.cache:
+            self.cache.discard(self)
+
+    @property
+    def tiles(self):
+        self.ensure_raster()
+        return self._tiles
+
+    def ensure_raster(self):
+        # Rasterizes the stroke again if its tiles were dropped, returning
+        # the last sample drawn for Stroke.mark_rendered()
+        if self._tiles is None:
+            self._tiles = {}
+            final_dirty = self._final_dirty
+            samples = self.stroke.samples()
+            self.stroke.rasterize(self, self.stroke.outlines(samples))
+            self._final_dirty = final_dirty
+            if len(samples) > 1:
+                return samples[-1]
+
+    def drop_raster(self):
+        if self.stroke is not None:
+            self._tiles = None
+            if self.rasters:
+                self.rasters.discard(self)
 
     def _opaque_copy(self):
-        result = Overlay(self.rect.topLeft(), self.pixmap.copy())
+        result = Overlay()
+        result._tiles = dict(self.tiles)
+        result.rect = self.rect
         result.opacity = 1
         return result
 
     def __repr__(self):
-        return f'<Overlay {self.rect}>'
+        return f'<Overlay {self.rect} ({self.nbytes // TILE_BYTES} tiles)>'
+
+    def set_blending(self, composition_mode, opacity):
+        if (composition_mode, opacity) != (self.composition_mode, self.opacity):
+            self.composition_mode = composition_mode
+            self.opacity = opacity
+            self.forget_final()
 
-    def paint(self, painter):
+    def paint(self, painter, rect=None):
         if self.rect:
             painter.setOpacity(self.opacity)
             painter.setCompositionMode(self.composition_mode)
-            painter.drawPixmap(self.rect.topLeft(), self.pixmap)
+            if rect is None:
+                for (tx, ty), tile in self.tiles.items():
+                    draw_tile(painter, QPoint(tx * TILE_SIZE, ty * TILE_SIZE), tile)
+                return
+            for key in tile_keys(rect.intersected(self.rect)):
+                tile = self.tiles.get(key)
+                if tile:
+                    tx, ty = key
+                    part = tile_rect(key).intersected(rect)
+                    draw_tile(
+                        painter, part, tile,
+                        part.translated(-tx * TILE_SIZE, -ty * TILE_SIZE),
+                    )
 
     def reserve(self, rect):
         if self.rect:
-            new_rect = self.rect.united(rect)
-        else:
-            new_rect = rect
-        new_pixmap = QPixmap(new_rect.width(), new_rect.height())
-        new_pixmap.fill(QColor(0, 0, 0, 0))
-        if self.pixmap:
-            painter = QPainter(new_pixmap)
-            painter.drawPixmap(
-                self.rect.left() - new_rect.left(),
-                self.rect.top() - new_rect.top(),
-                self.pixmap
-            )
-            painter.end()
-        self.pixmap = new_pixmap
-        self.rect = new_rect
-
-    def add(self, other_overlay):
-        if self.rect:
-            self.reserve(other_overlay.rect)
-            painter = QPainter(self.pixmap)
-            painter.drawPixmap(
-                other_overlay.rect.left() - self.rect.left(),
-                other_overlay.rect.top() - self.rect.top(),
-                other_overlay.pixmap
-            )
-            painter.end()
+            self.rect = self.rect.united(rect)
         else:
-            self.pixmap = other_overlay.pixmap.copy()
-            self.rect = other_overlay.rect
+            self.rect = rect
+        added = False
+        for key in tile_keys(rect):
+            if key not in self.tiles:
+                self.tiles[key] = new_tile()
+                added = True
+        if added and self.rasters:
+            self.rasters.add(self)
 
     @contextlib.contextmanager
-    def painter_context(self):
-        self._final = None
-        if self.pixmap:
-            painter = QPainter(self.pixmap)
-            painter.translate(-self.rect.topLeft())
-            try:
-                yield painter
-            finally:
+    def painter_context(self, rect=None):
+        if rect is None:
+            keys = list(self.tiles)
+        else:
+            keys = [k for k in tile_keys(rect) if k in self.tiles]
+        self._final_dirty.update(keys)
+        painters = []
+        try:
+            for key in keys:
+                tx, ty = key
+                painter = QPainter(self.tiles[key])
+                painter.translate(-tx * TILE_SIZE, -ty * TILE_SIZE)
+                painters.append(painter)
+            yield MultiPainter(painters)
+        finally:
+            for painter in painters:
                 painter.end()
+
+    def _composite_tile(self, key, base):
+        if base:
+            tile = base.copy()
         else:
-            yield None
+            tile = new_tile()
+        painter = QPainter(tile)
+        painter.setOpacity(self.opacity)
+        painter.setCompositionMode(self.composition_mode)
+        draw_tile(painter, QPoint(0, 0), self.tiles[key])
+        painter.end()
+        return tile
+
+    def _update_final(self, base):
+        # Before compositing: rasterizing an eraser stroke sets the blending
+        self.ensure_raster()
+        if self.rasters:
+            self.rasters.touch(self)
+        if self._final is None:
+            self._final = base._opaque_copy()
+            self._final_dirty = set(self.tiles)
+            if self.cache:
+                self.cache.misses += 1
+        if self._final_dirty:
+            for key in self._final_dirty:
+                self._final.tiles[key] = self._composite_tile(
+                    key, base.tiles.get(key),
+                )
+            self._final_dirty = set()
+            if self._final.rect:
+                self._final.rect = self._final.rect.united(self.rect)
+            else:
+                self._final.rect = self.rect
+            if self.cache:
+                self.cache.add(self)
 
     @property
     def final(self):
-        if self._final:
-            return self._final
-        if self.prev and self.prev.final.pixmap:
-            self._final = self.prev.final._opaque_copy()
-        else:
-            self._final = Overlay()
-            self._final.opacity = 1
-        if self.pixmap:
-            self._final.reserve(self.rect)
-            with self._final.painter_context() as painter:
-                self.paint(painter)
+        chain = []
+        overlay = self
+        while overlay and (overlay._final is None or overlay._final_dirty):
+            chain.append(overlay)
+            overlay = overlay.prev
+        if not chain and self.cache:
+            self.cache.hits += 1
+            self.cache.touch(self)
+        base = overlay._final if overlay else Overlay()
+        start = time.perf_counter()
+        for overlay in reversed(chain):
+            overlay._update_final(base)
+            base = overlay._final
+            if overlay not in (self, self.prev) and not overlay.is_keyframe:
+                overlay.forget_final()
+        if chain:
+            STATS.add('final_us', (time.perf_counter() - start) * 1e6)
         return self._final
 
 
+class WetInk:
+    # Drying segments of recent ink, plus a provisional segment where the
+    # pen is predicted to be, replaced by each new prediction
+    def __init__(self):
+        self.segments = collections.deque()
+        self.predicted = None
+
+    def __bool__(self):
+        return bool(self.segments or self.predicted)
+
+    def __repr__(self):
+        return f'<WetInk {len(self.segments)} segments>'
+
+    @property
+    def rect(self):
+        result = QRect()
+        for t, rect, color, polygon in self.segments:
+            result = result.united(rect)
+        if self.predicted:
+            result = result.united(self.predicted[1])
+        return result
+
+    def predict(self, segment, until):
+        # Replaces the predicted segment, which is dropped at `until` if
+        # no real samples come in by then
+        result = self.predicted[1] if self.predicted else QRect()
+        self.predicted = None
+        if segment:
+            self.predicted = (until, *segment)
+            result = result.united(segment[0])
+        return result
+
+    def add(self, rect, color, polygon):
+        self.segments.append((time.monotonic(), rect, color, polygon))
+
+    def expire(self, now):
+        result = QRect()
+        while self.segments and self.segments[0][0] + WET_SECONDS < now:
+            t, rect, color, polygon = self.segments.popleft()
+            result = result.united(rect)
+        if self.predicted and self.predicted[0] < now:
+            result = result.united(self.predict(None, None))
+        return result
+
+    def clear(self):
+        result = self.rect
+        self.segments.clear()
+        self.predicted = None
+        return result
+
+    def paint(self, painter, rect, now):
+        # Ink is as opaque as in scribbles while wet, then fades
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        for t, seg_rect, color, polygon in self.segments:
+            if seg_rect.intersects(rect):
+                painter.setOpacity(Overlay.opacity * WET_FADE ** (now - t))
+                painter.setBrush(color)
+                painter.drawPolygon(polygon, Qt.WindingFill)
+        if self.predicted and self.predicted[1].intersects(rect):
+            until, seg_rect, color, polygon = self.predicted
+            painter.setOpacity(Overlay.opacity)
+            painter.setBrush(color)
+            painter.drawPolygon(polygon, Qt.WindingFill)
+
+
+def predict_sample(samples, ahead):
+    # Extrapolates where the pen will be `ahead` seconds after the last
+    # sample, from its velocity and pressure change over `samples`; None if
+    # there is nothing to go on. Looks no further ahead than the samples
+    # span, so a single quick jitter can't fling the ink across the screen.
+    if len(samples) < 2:
+        return None
+    span = samples[-1, 3] - samples[0, 3]
+    if span <= 0:
+        return None
+    rates = (samples[-1, :3] - samples[0, :3]) / span
+    predicted = samples[-1].copy()
+    predicted[:3] += rates * min(ahead, span)
+    predicted[2] = min(max(predicted[2], 0), 1)
+    predicted[3] += ahead
+    if (predicted[:2] == samples[-1, :2]).all():
+        return None
+    return predicted
+
+
+class Renderer(QObject):
+    # Runs jobs that touch Overlays and their finals, in order.
+    # This one runs them right away on the calling thread.
+    done = Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.done.connect(self._call)
+
+    def _call(self, callback, result):
+        callback(result)
+
+    def submit(self, func, callback=None):
+        result = func()
+        if callback:
+            callback(result)
+
+    def wait(self):
+        pass
+
+
+class ThreadedRenderer(Renderer):
+    # Runs jobs on a worker thread; callbacks still run on the GUI thread.
+    # Tiles must be QImages (TILE_IMAGES), which can be painted anywhere.
+    def __init__(self):
+        import concurrent.futures
+        super().__init__()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            1, 'pointout-render',
+        )
+
+    def submit(self, func, callback=None):
+        def job():
+            try:
+                result = func()
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                raise
+            if callback:
+                self.done.emit(callback, result)
+        self.executor.submit(job)
+
+    def wait(self):
+        self.executor.submit(lambda: None).result()
+        QApplication.processEvents()
+
+
+def final_snapshot(scribble):
+    if scribble is None:
+        return Overlay()
+    return scribble.final._opaque_copy()
+
+
+class InputQueue:
+    # Pen and mouse samples waiting for the next frame. Event timestamps
+    # are mapped to time.monotonic() using the smallest delivery delay seen.
+    def __init__(self):
+        self.samples = collections.deque()
+        self.clock_offset = None
+
+    def __bool__(self):
+        return bool(self.samples)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def push(self, event_ms, press, pos, pressure=0.5, erase=False):
+        offset = time.monotonic() - event_ms / 1000
+        if (
+            self.clock_offset is None
+            or offset < self.clock_offset
+            or offset > self.clock_offset + 1  # clock reset or wrapped
+        ):
+            self.clock_offset = offset
+        t = event_ms / 1000 + self.clock_offset
+        self.samples.append((t, press, pos, pressure, erase))
+
+    def drain(self):
+        while self.samples:
+            yield self.samples.popleft()
+
+
+class Recorder:
+    # Writes what the widget shows as a PNG sequence with alpha, plus an
+    # ffconcat list giving each frame's duration. Only repainted parts are
+    # captured; a writer thread applies them to its canvas and writes a
+    # frame for each batch, so unchanged stretches cost nothing.
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self.write_frames, name='pointout-recorder', daemon=True,
+        )
+        self.thread.start()
+
+    def capture(self, widget, region, now):
+        patches = []
+        for rect in region:
+            patch = QImage(rect.size(), QImage.Format_ARGB32_Premultiplied)
+            patch.fill(QColor(0, 0, 0, 0))
+            painter = QPainter(patch)
+            painter.translate(-rect.topLeft())
+            widget.shown_final.paint(painter, rect)
+            widget.current_wet.paint(painter, rect, now)
+            painter.end()
+            patches.append((rect.topLeft(), patch))
+        self.queue.put((now, patches))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def write_frames(self):
+        canvas = QImage(self.size, QImage.Format_ARGB32_Premultiplied)
+        canvas.fill(QColor(0, 0, 0, 0))
+        with open(os.path.join(self.directory, 'frames.ffconcat'), 'w') as f:
+            f.write('ffconcat version 1.0\n')
+            frame = 0
+            last_time = None
+            while True:
+                batch = [self.queue.get()]
+                while not self.queue.empty():
+                    batch.append(self.queue.get())
+                frames = [item for item in batch if item is not None]
+                if frames:
+                    painter = QPainter(canvas)
+                    painter.setCompositionMode(QPainter.CompositionMode_Source)
+                    for now, patches in frames:
+                        for pos, patch in patches:
+                            painter.drawImage(pos, patch)
+                    painter.end()
+                    now = frames[-1][0]
+                    if last_time is not None:
+                        f.write(f'duration {now - last_time:.6f}\n')
+                    name = f'frame-{frame:06d}.png'
+                    canvas.save(os.path.join(self.directory, name))
+                    f.write(f'file {name}\n')
+                    f.flush()
+                    frame += 1
+                    last_time = now
+                if None in batch:
+                    if last_time is not None:
+                        f.write(f'duration {time.monotonic() - last_time:.6f}\n')
+                    return
+
+
 class DrawCommand(QUndoCommand):
-    def __init__(self, widget, tool):
+    def __init__(self, widget, tool, scribbles):
         super().__init__(f"Draw with {tool.name}")
         self.widget = widget
-        self.scribbles = widget.scribbles
-        if self.scribbles:
-            self.scribble = Overlay(prev=self.scribbles[-1])
-        else:
-            self.scribble = Overlay()
+        self.scribbles = scribbles
+        self.stroke = Stroke()
+        self.scribble = Overlay(
+            prev=self.scribbles[-1] if self.scribbles else None,
+            cache=widget.final_cache,
+            stroke=self.stroke,
+            rasters=widget.raster_cache,
+        )
         self.tool = tool
 
     def undo(self):
+        self.widget.flush_ink()
         popped = self.scribbles.pop()
-        self.widget.current_wet = Overlay()
+        self.widget.clear_wet()
         if popped.rect:
-            self.widget.update(popped.rect)
+            self.widget.schedule_update(popped.rect)
             assert popped == self.scribble
 
     def redo(self):
         self.scribbles.append(self.scribble)
         if self.scribble.rect:
-            self.widget.update(self.scribble.rect)
+            self.widget.schedule_update(self.scribble.rect)
+
+
+class EraseStrokesCommand(QUndoCommand):
+    # Removes whole scribbles from a picture. Consecutive erasures in one
+    # gesture merge into one command, undone step by step.
+    def __init__(self, widget, scribbles, erased, gesture):
+        super().__init__("Erase strokes")
+        self.widget = widget
+        self.scribbles = scribbles
+        self.gesture = gesture
+        erased = sorted(erased, key=lambda s: s.index)
+        self.steps = [([s.index for s in erased], erased)]
+
+    def id(self):
+        return 1
+
+    def mergeWith(self, other):
+        if other.gesture != self.gesture:
+            return False
+        self.steps.extend(other.steps)
+        return True
+
+    def redo(self):
+        self.widget.flush_ink()
+        for indices, erased in self.steps:
+            for i in reversed(indices):
+                del self.scribbles[i]
+            relink_scribbles(self.widget, self.scribbles, indices[0], erased)
+
+    def undo(self):
+        self.widget.flush_ink()
+        for indices, erased in reversed(self.steps):
+            for i, scribble in zip(indices, erased):
+                self.scribbles.insert(i, scribble)
+            relink_scribbles(self.widget, self.scribbles, indices[0], [])
+
+
+def relink_scribbles(widget, scribbles, start, erased):
+    # Chains scribbles from `start` on to the ones now before them; their
+    # finals, and the erased scribbles' rasters, are dropped on the renderer
+    for i in range(start, len(scribbles)):
+        scribbles[i].prev = scribbles[i - 1] if i else None
+        scribbles[i].index = i
+    changed = scribbles[start:]
+    def job():
+        for scribble in changed:
+            scribble.forget_final()
+        for scribble in erased:
+            scribble.forget_final()
+            scribble.drop_raster()
+    widget.renderer.submit(job)
+    if widget.picture and widget.picture.scribbles is scribbles:
+        widget.clear_wet()
+        widget.refresh_final()
 
 
 class PictureItem(QStandardItem):
     def __init__(self, widget):
         super().__init__("Drawing")
+        self.id = next(widget.picture_ids)
         self.scribbles = []
+        self.stroke_index = StrokeIndex(self.all_scribbles)
         self.undo_stack = QUndoStack()
         self.undo_stack.indexChanged.connect(self.reset_props)
+        self.undo_stack.indexChanged.connect(self.trim_history)
         self.widget = widget
         widget.undo_group.addStack(self.undo_stack)
+        self.icon_final = None
+        self.thumbnail = None
+        self.thumbnail_tiles = {}
+        self.thumbnail_timer = QTimer()
+        self.thumbnail_timer.setSingleShot(True)
+        self.thumbnail_timer.timeout.connect(self.update_thumbnail)
 
     def start_scribble(self):
-        cmd = DrawCommand(self.widget, self.widget.tool)
+        cmd = DrawCommand(self.widget, self.widget.tool, self.scribbles)
+        for session in self.widget.sessions:
+            session.stroke_started(self, cmd)
         self.undo_stack.push(cmd)
 
+    def all_scribbles(self):
+        for i in range(self.undo_stack.count()):
+            command = self.undo_stack.command(i)
+            if isinstance(command, DrawCommand):
+                yield command.scribble
+
+    def drop_rasters(self):
+        scribbles = list(self.all_scribbles())
+        def job():
+            for scribble in scribbles:
+                scribble.drop_raster()
+        self.widget.renderer.submit(job)
+
+    def spill(self, spill_file):
+        scribbles = list(self.all_scribbles())
+        def job():
+            for scribble in scribbles:
+                scribble.drop_raster()
+                scribble.forget_final()
+                stroke = scribble.stroke
+                stroke.finish()
+                if isinstance(stroke.points, array.array) and stroke.points:
+                    stroke.points = spill_file.store(stroke.points)
+            spill_file.page_out()
+        self.widget.renderer.submit(job)
+
+    def trim_history(self):
+        # Keep the finals needed to paint and continue drawing (the last
+        # two scribbles) and keyframes; the FinalCache bounds the rest.
+        keep = self.scribbles[-2:]
+        scribbles = list(self.all_scribbles())
+        def job():
+            for scribble in scribbles:
+                if any(scribble is s for s in keep):
+                    continue
+                if not scribble.is_keyframe:
+                    scribble.forget_final()
+        self.widget.renderer.submit(job)
+
     def reset_props(self):
         if self.undo_stack.index() == self.undo_stack.count():
             self.setText(f"Drawing ({self.undo_stack.index()})")
         else:
             self.setText(f"Drawing ({self.undo_stack.index()}/{self.undo_stack.count()})")
-        if self.scribbles:
-            s = self.scribbles[-1]
-            if s.final.pixmap:
-                self.setIcon(s.final.pixmap)
+        self.widget.refresh_final()
+
+    def update_icon(self, final):
+        self.icon_final = final
+        if not self.thumbnail_timer.isActive():
+            self.thumbnail_timer.start(THUMBNAIL_MS)
+
+    def update_thumbnail(self):
+        # Only tiles that changed since the last thumbnail are scaled down
+        final = self.icon_final
+        self.icon_final = None
+        size = thumbnail_size(self.widget.size())
+        if self.thumbnail is None or self.thumbnail.size() != size:
+            self.thumbnail = QImage(size, QImage.Format_ARGB32_Premultiplied)
+            self.thumbnail.fill(QColor(0, 0, 0, 0))
+            self.thumbnail_tiles = {}
+        tiles = {key: tile.cacheKey() for key, tile in final.tiles.items()}
+        painter = QPainter(self.thumbnail)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for key in set(self.thumbnail_tiles) | set(tiles):
+            if self.thumbnail_tiles.get(key) == tiles.get(key):
+                continue
+            tx, ty = key
+            target = QPoint(tx * THUMBNAIL_TILE, ty * THUMBNAIL_TILE)
+            if key in tiles:
+                draw_tile(painter, target, final.tiles[key].scaled(
+                    THUMBNAIL_TILE, THUMBNAIL_TILE,
+                    Qt.IgnoreAspectRatio, Qt.SmoothTransformation,
+                ))
             else:
-                self.setIcon(QIcon())
+                painter.fillRect(
+                    QRect(target, QSize(THUMBNAIL_TILE, THUMBNAIL_TILE)),
+                    QColor(0, 0, 0, 0),
+                )
+        painter.end()
+        self.thumbnail_tiles = tiles
+        if tiles:
+            self.setIcon(QPixmap.fromImage(self.thumbnail))
         else:
             self.setIcon(QIcon())
 
@@ -195,6 +1317,30 @@ class SignalingProperty:
             self.signal.__get__(instance, type(instance)).emit(value)
 
 
+def init_overlay_window(widget):
+    widget.setWindowTitle('pointout canvas')
+    widget.setWindowFlags(
+        widget.windowFlags()
+        | Qt.Window
+        | Qt.WindowTransparentForInput
+        | Qt.WindowDoesNotAcceptFocus
+        | Qt.FramelessWindowHint
+        | Qt.WindowStaysOnTopHint
+    )
+    widget.setAttribute(Qt.WA_TransparentForMouseEvents)
+    widget.setAttribute(Qt.WA_NoSystemBackground)
+    widget.setAttribute(Qt.WA_TranslucentBackground)
+    widget.setAttribute(Qt.WA_TabletTracking)
+
+    cursor_bitmap = QBitmap.fromData(QSize(5, 5), bytes((
+        0b00000, 0b00000, 0b00100, 0b00000, 0b00000,
+    )))
+    mask_bitmap = QBitmap.fromData(QSize(5, 5), bytes((
+        0b00100, 0b00000, 0b10101, 0b00000, 0b00100,
+    )))
+    widget.setCursor(QCursor(cursor_bitmap, mask_bitmap))
+
+
 class OverlayWidget(QWidget):
     grab_updated = Signal(bool)
     can_clear_changed = Signal(bool)
@@ -205,56 +1351,78 @@ class OverlayWidget(QWidget):
     can_redo = SignalingProperty(can_redo_changed)
     _last_cursor_pos = None
     _grabbing_mouse = False
-
-    def __init__(self):
+    pending_scribble = None
+    input_log = None
+    sessions = ()
+    recorder = None
+    spill_file = None
+    resident_pictures = RESIDENT_PICTURES
+    predict_seconds = 0
+    drawn_scribble = None
+    gesture_tool = None
+    views = ()
+    erase_gesture = None
+
+    def __init__(self, renderer=None):
         super().__init__()
-        self.setWindowTitle('pointout canvas')
-        self.setWindowFlags(
-            self.windowFlags()
-            | Qt.Window
-            | Qt.WindowTransparentForInput
-            | Qt.WindowDoesNotAcceptFocus
-            | Qt.FramelessWindowHint
-            | Qt.WindowStaysOnTopHint
-        )
-        self.setAttribute(Qt.WA_TransparentForMouseEvents)
-        self.setAttribute(Qt.WA_NoSystemBackground)
-        self.setAttribute(Qt.WA_TranslucentBackground)
-        self.setAttribute(Qt.WA_TabletTracking)
-
-        self.current_wet = Overlay()
-
+        init_overlay_window(self)
+
+        self.damage = QRegion()
+        self.frame_timer = QTimer()
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setTimerType(Qt.PreciseTimer)
+        self.frame_timer.timeout.connect(self.frame_update)
+
+        self.current_wet = WetInk()
+
+        self.renderer = renderer or Renderer()
+        self.shown_final = Overlay()
+        self.uploaded_tiles = {}
+        self.final_cache = FinalCache()
+        self.raster_cache = RasterCache()
+        self.picture_ids = itertools.count()
+        self.erase_gestures = itertools.count()
+        self.sessions = []
+        self.views = []
+        self.recent_pictures = []
         self.undo_group = QUndoGroup()
         self.picture_model = QStandardItemModel()
         self.selection_model = QItemSelectionModel(self.picture_model)
         self.clear(force=True)
         self.selection_model.currentChanged.connect(self.picture_switched)
+        self.selection_model.currentChanged.connect(self.picture_left)
         self.picture_switched()
         self.undo_group.canUndoChanged.connect(self.update_action_availability)
         self.undo_group.canRedoChanged.connect(self.update_action_availability)
 
-        cursor_bitmap = QBitmap.fromData(QSize(5, 5), bytes((
-            0b00000, 0b00000, 0b00100, 0b00000, 0b00000,
-        )))
-        mask_bitmap = QBitmap.fromData(QSize(5, 5), bytes((
-            0b00100, 0b00000, 0b10101, 0b00000, 0b00100,
-        )))
-        self.setCursor(QCursor(cursor_bitmap, mask_bitmap))
-
         self.anim_timer = QTimer()
         self.anim_timer.timeout.connect(self.anim_update)
-        self.anim_timer.start(1000//30)
+        self.anim_timer.setInterval(WET_MS)
         self.anim_timer.setTimerType(Qt.CoarseTimer)
-        self.wet_end = time.monotonic()
 
-        self.eraser = Eraser()
-        self.tool = Marker()
+        self.input_queue = InputQueue()
+        self.unpainted_input = []
+        self.eraser = TOOLS_BY_NAME['Eraser']
+        self.tool = TOOLS_BY_NAME['Marker']
         self.last_point = 0
 
     def picture_switched(self):
         self.undo_group.setActiveStack(self.picture.undo_stack)
         self.update_action_availability()
-        self.update()
+        self.refresh_final()
+        if self.picture in self.recent_pictures:
+            self.recent_pictures.remove(self.picture)
+        self.recent_pictures.insert(0, self.picture)
+        while len(self.recent_pictures) > self.resident_pictures:
+            if self.spill_file is None:
+                self.spill_file = SpillFile()
+            self.recent_pictures.pop().spill(self.spill_file)
+
+    def picture_left(self, current, previous):
+        # Rasters of pictures not on screen can be rebuilt from strokes
+        picture = self.picture_model.itemFromIndex(previous)
+        if picture:
+            picture.drop_rasters()
 
     def update_action_availability(self):
         self.can_clear = bool(self.undo_stack.count())
@@ -287,90 +1455,271 @@ class OverlayWidget(QWidget):
     @tool.setter
     def tool(self, new_tool):
         self._tool = new_tool
+        for session in self.sessions:
+            session.tool_changed(new_tool)
         if new_tool is None:
             self.update_grab(False)
 
     def anim_update(self):
-        if self.current_wet.rect is not None:
-            with self.current_wet.painter_context() as painter:
-                painter.setBrush(QColor(0, 0, 0, 255))
-                painter.setPen(QPen(0))
-                painter.setOpacity(0.1)
-                painter.setCompositionMode(QPainter.CompositionMode_DestinationOut)
-                painter.drawRect(self.current_wet.rect)
-            self.update(self.current_wet.rect)
-            if self.wet_end < time.monotonic():
-                self.current_wet = Overlay()
+        with STATS.timed('anim_us'):
+            expired = self.current_wet.expire(time.monotonic())
+            self.schedule_update(expired.united(self.current_wet.rect))
+        if not self.current_wet:
+            self.anim_timer.stop()
+
+    def release_input(self):
+        # The pen was lifted; its queued samples end the stroke
+        self.drain_input()
+        self.finish_stroke()
+        self.gesture_tool = None
+
+    def finish_stroke(self):
+        if self.drawn_scribble is not None:
+            picture, scribble = self.drawn_scribble
+            scribble.stroke.finish()
+            picture.stroke_index.add(scribble)
+            self.drawn_scribble = None
+
+    @property
+    def drawn_stroke(self):
+        if self.drawn_scribble is not None:
+            return self.drawn_scribble[1].stroke
+
+    def clear_wet(self):
+        self.schedule_update(self.current_wet.clear())
+
+    def schedule_update(self, rect):
+        self.damage |= rect
+        if not self.frame_timer.isActive():
+            self.frame_timer.start(FRAME_MS)
+
+    def frame_update(self):
+        if TRACE.paint <= DEBUG:
+            TRACE('paint', DEBUG, 'frame', len(self.input_queue))
+        with STATS.timed('frame_us'):
+            self.drain_input()
+            self.flush_ink()
+        STATS.add('dirty_px', sum(r.width() * r.height() for r in self.damage))
+        self.update(self.damage)
+        for view in self.views:
+            if view.isVisible():
+                view.update(self.damage.translated(-view.offset))
+        if self.recorder and not self.damage.isEmpty():
+            self.recorder.capture(self, self.damage, time.monotonic())
+        self.damage = QRegion()
+
+    def drain_input(self):
+        for t, press, pos, pressure, erase in self.input_queue.drain():
+            if press:
+                self.start_line(pos, t=t)
+            else:
+                self.add_point(pos, pressure=pressure, erase=erase, t=t)
+            self.unpainted_input.append(t)
+
+    def log_input(self, *event):
+        if self.input_log:
+            self.input_log.write(json.dumps(event) + '\n')
+
+    def queue_input(self, e, press, pos, pressure=0.5, erase=False):
+        if TRACE.input <= DEBUG:
+            TRACE(
+                'input', DEBUG, 'press' if press else 'move',
+                pos.x(), pos.y(), pressure, erase,
+            )
+        if press:
+            self.log_input('press', pos.x(), pos.y())
+        else:
+            self.log_input('move', pos.x(), pos.y(), pressure, erase)
+        self.input_queue.push(e.timestamp(), press, pos, pressure, erase)
+        if not self.frame_timer.isActive():
+            self.frame_timer.start(FRAME_MS)
+
+    def flush_ink(self):
+        scribble = self.pending_scribble
+        if scribble:
+            self.pending_scribble = None
+            stroke = scribble.stroke
+            outlines = stroke.fresh_outlines()
+            for tool, rect, color, polygon in outlines:
+                self.current_wet.add(rect, color, polygon)
+                self.damage |= rect
+            if self.predict_seconds:
+                self.predict_ink(stroke)
+            def job():
+                if scribble._tiles is None:
+                    return scribble.ensure_raster()  # evicted
+                stroke.rasterize(scribble, outlines)
+            self.renderer.submit(job, stroke.mark_rendered)
+            self.refresh_final()
+            if self.current_wet and not self.anim_timer.isActive():
+                self.anim_timer.start()
+
+    def predict_ink(self, stroke):
+        # Provisional ink from the last sample to where the pen is headed,
+        # so it doesn't trail behind a moving pen by a frame or two
+        samples = stroke.samples(max(len(stroke) - PREDICT_SAMPLES, 0))
+        if len(samples) == len(stroke):
+            samples = samples[1:]  # the press sample has no pressure
+        predicted = predict_sample(samples, self.predict_seconds)
+        segment = None
+        if predicted is not None:
+            tool = TOOLS[int(predicted[4])]
+            segment = tool.outline(np.stack([samples[-1], predicted]))
+        self.damage |= self.current_wet.predict(
+            segment, time.monotonic() + self.predict_seconds,
+        )
+
+    def refresh_final(self):
+        scribbles = self.scribbles
+        self.renderer.submit(
+            functools.partial(
+                final_snapshot, scribbles[-1] if scribbles else None,
+            ),
+            functools.partial(self.final_rendered, self.picture),
+        )
+
+    def final_rendered(self, picture, final):
+        if TILE_IMAGES:
+            uploaded = {}
+            for key, image in final.tiles.items():
+                pixmap = self.uploaded_tiles.get(id(image), (None, None))[1]
+                if pixmap is None or self.uploaded_tiles[id(image)][0] is not image:
+                    pixmap = QPixmap.fromImage(image)
+                uploaded[id(image)] = image, pixmap
+                final.tiles[key] = pixmap
+            self.uploaded_tiles = uploaded
+        picture.update_icon(final)
+        if picture is not self.picture:
+            return
+        old_tiles = self.shown_final.tiles
+        for key in set(old_tiles) | set(final.tiles):
+            if old_tiles.get(key) is not final.tiles.get(key):
+                self.schedule_update(tile_rect(key))
+        self.shown_final = final
+        for view in self.views:
+            view.fit()
 
     def paintEvent(self, e):
-        painter = QPainter(self)
-        if self.scribbles:
-            self.scribbles[-1].final.paint(painter)
-        painter.setOpacity(1)
-        if self.current_wet:
-            self.current_wet.paint(painter)
+        self.paint_picture(self, e.region(), QPoint(0, 0))
+
+    def paint_picture(self, window, region, offset):
+        # Paints `region` of a window whose top left is at `offset`
+        painter = QPainter(window)
+        painter.translate(-offset)
+        start = now = time.monotonic()
+        for rect in region:
+            rect = rect.translated(offset)
+            painter.setClipRect(rect)
+            self.shown_final.paint(painter, rect)
+            self.current_wet.paint(painter, rect, now)
         painter.end()
+        now = time.monotonic()
+        if TRACE.paint <= DEBUG:
+            TRACE('paint', DEBUG, 'paint', region.rectCount(), now - start)
+        STATS.add('paint_us', (now - start) * 1e6)
+        for t in self.unpainted_input:
+            STATS.add('input_latency_us', (now - t) * 1e6)
+        self.unpainted_input = []
 
     def tabletEvent(self, e):
+        self.tablet_input(e, e.posF())
+
+    def tablet_input(self, e, pos):
         if e.type() == QEvent.TabletPress:
-            self.start_line(e.posF())
+            self.queue_input(e, True, pos)
         if e.type() in (QEvent.TabletMove, QEvent.TabletRelease):
-            self.add_point(
-                pos=e.posF(),
+            self.queue_input(
+                e, False, pos,
                 pressure=e.pressure(),
                 erase=e.pointerType() == QPointingDevice.PointerType.Eraser,
             )
+        if e.type() == QEvent.TabletRelease:
+            self.release_input()
         e.accept()
 
     def mousePressEvent(self, e):
-        self.start_line(e.localPos())
+        self.queue_input(e, True, e.localPos())
 
     def mouseMoveEvent(self, e):
-        self.add_point(e.localPos())
+        self.queue_input(e, False, e.localPos())
 
-    def start_line(self, pos):
+    def mouseReleaseEvent(self, e):
+        self.release_input()
+
+    def start_line(self, pos, *, t=None):
+        self.flush_ink()
+        self.finish_stroke()
+        self.damage |= self.current_wet.predict(None, None)
         self.last_point = pos
+        # Whether the press draws or erases strokes is decided here
+        self.gesture_tool = self.tool
+        if isinstance(self.tool, StrokeEraser):
+            self.erase_gesture = next(self.erase_gestures)
+            self.erase_strokes(pos, pos, 0.5)
+            return
         self.picture.start_scribble()
+        self.drawn_scribble = self.picture, self.scribbles[-1]
+        self.drawn_stroke.append(pos, 0, self.tool, t)
         self.update_action_availability()
 
-    def add_point(self, pos, *, pressure=0.5, erase=False):
-        tool = self.tool
-        if self.tool is None:
+    def add_point(self, pos, *, pressure=0.5, erase=False, t=None):
+        tool = self.gesture_tool
+        if tool is None:
+            self.last_point = pos  # the pen is up
+            return
+        if isinstance(tool, StrokeEraser):
+            # Either end of the pen erases strokes
+            if self.last_point and pressure:
+                self.erase_strokes(self.last_point, pos, pressure)
+            self.last_point = pos
             return
         if erase:
             tool = self.eraser
-        if not self.scribbles:
-            self.start_line(pos)
         if self.last_point:
-            tool.set_size(pressure)
-            update_rect = QRect(self.last_point.toPoint(), pos.toPoint())
-            update_rect = update_rect.normalized().adjusted(
-                -tool.size-1, -tool.size-1, tool.size+1, tool.size+1,
-            )
-            tool.draw(
-                self.last_point, pos,
-                update_rect,
-                self.scribbles, self.current_wet
-            )
-            self.update(update_rect)
+            scribble = self.drawn_scribble[1]
+            if self.pending_scribble is not scribble:
+                self.flush_ink()
+            self.pending_scribble = scribble
+            scribble.stroke.append(pos, pressure, tool, t)
+            if not self.frame_timer.isActive():
+                self.frame_timer.start(FRAME_MS)
         self.last_point = pos
-        self.picture.reset_props()
-        self.update_wet()
+
+    def erase_strokes(self, start, end, pressure):
+        # Erases the scribbles the eraser touches between two samples
+        picture = self.picture
+        radius = max(pressure * self.gesture_tool.scale, 1) / 2
+        hits = picture.stroke_index.hits(picture.scribbles, start, end, radius)
+        if hits:
+            for session in self.sessions:
+                session.strokes_erased(
+                    picture, self.erase_gesture, sorted(s.index for s in hits),
+                )
+            self.undo_stack.push(EraseStrokesCommand(
+                self, picture.scribbles, hits, self.erase_gesture,
+            ))
 
     def clear(self, *, force=False):
         if force or self.can_clear:
+            self.log_input('clear')
+            TRACE('undo', INFO, 'clear', self.picture_model.rowCount())
+            self.flush_ink()
             pi = PictureItem(self)
             idx = self.selection_model.currentIndex()
             if idx:
                 self.picture_model.insertRow(idx.row() + 1, pi)
             else:
                 self.picture_model.appendRow(pi)
+            for session in self.sessions:
+                session.picture_added(pi)
             self.selection_model.setCurrentIndex(
                 self.picture_model.indexFromItem(pi),
                 QItemSelectionModel.ClearAndSelect,
             )
 
     def undo(self):
+        self.log_input('undo')
+        TRACE('undo', INFO, 'undo', self.undo_stack.index())
         if self.undo_stack.canUndo():
             self.undo_stack.undo()
         elif self.can_undo:
@@ -383,6 +1732,8 @@ class OverlayWidget(QWidget):
                 )
 
     def redo(self):
+        self.log_input('redo')
+        TRACE('undo', INFO, 'redo', self.undo_stack.index())
         if self.undo_stack.canRedo():
             self.undo_stack.redo()
         elif self.can_redo:
@@ -394,6 +1745,58 @@ class OverlayWidget(QWidget):
                     QItemSelectionModel.ClearAndSelect,
                 )
 
+    def collect_stats(self, callback):
+        # Calls callback with STATS, cache counters and the memory
+        # held by each picture, measured on the render thread
+        pictures = [
+            (picture.text(), list(picture.all_scribbles()))
+            for picture in map(
+                self.picture_model.item, range(self.picture_model.rowCount()),
+            )
+        ]
+        cache = self.final_cache
+        rasters = self.raster_cache
+        def job():
+            memory = []
+            for name, scribbles in pictures:
+                final_tiles = set()
+                for scribble in scribbles:
+                    if scribble._final and scribble._final._tiles:
+                        final_tiles.update(
+                            id(t) for t in scribble._final._tiles.values()
+                        )
+                memory.append({
+                    'name': name,
+                    'stroke_bytes': sum(s.stroke.nbytes for s in scribbles),
+                    'raster_bytes': sum(s.nbytes for s in scribbles),
+                    'final_bytes': len(final_tiles) * TILE_BYTES,
+                    'scribbles': [
+                        {
+                            'stroke_bytes': s.stroke.nbytes,
+                            'raster_bytes': s.nbytes,
+                            'final': s._final is not None,
+                        }
+                        for s in scribbles
+                    ],
+                })
+            return {
+                'histograms': STATS.to_dict(),
+                'final_cache': {
+                    'bytes': cache.nbytes,
+                    'finals': len(cache.entries),
+                    'hits': cache.hits,
+                    'misses': cache.misses,
+                    'evictions': cache.evictions,
+                },
+                'raster_cache': {
+                    'bytes': rasters.nbytes,
+                    'rasters': len(rasters.entries),
+                    'evictions': rasters.evictions,
+                },
+                'pictures': memory,
+            }
+        self.renderer.submit(job, callback)
+
     def create_undo_action(self):
         act = QAction('Undo')
         act.triggered.connect(self.undo)
@@ -408,9 +1811,6 @@ class OverlayWidget(QWidget):
         self.can_redo_changed.connect(act.setEnabled)
         return act
 
-    def update_wet(self, seconds=1):
-        self.wet_end = time.monotonic() + seconds
-
     def update_grab(self, grab):
         was_grabbing_mouse = self._grabbing_mouse
         if self.tool is None:
@@ -419,85 +1819,652 @@ class OverlayWidget(QWidget):
             if not self.tool:
                 return False
             self._grabbing_mouse = True
-            self.grabMouse()
+            for view in self.views:
+                view.fit()
+            self.grabber().grabMouse()
         else:
-            self.releaseMouse()
+            for widget in (self, *self.views):
+                widget.releaseMouse()
             self._grabbing_mouse = False
+            for view in self.views:
+                view.fit()
             if self._last_cursor_pos:
                 QCursor.setPos(self._last_cursor_pos)
         self.grab_updated.emit(self._grabbing_mouse)
 
+    def grabber(self):
+        # The window under the pointer, to take input while drawing
+        screen = QApplication.screenAt(QCursor.pos())
+        for view in self.views:
+            if view.target_screen is screen:
+                return view
+        return self.views[0] if self.views else self
+
+
+class ScreenView(QWidget):
+    # Shows an OverlayWidget's picture on one screen and passes input on
+    # to it. Picture coordinates are the OverlayWidget's, so it can stay
+    # hidden and span all screens. When not drawing, the window only
+    # covers the tiles with ink on its screen, or is hidden.
+    def __init__(self, overlay, screen):
+        super().__init__()
+        init_overlay_window(self)
+        self.overlay = overlay
+        self.target_screen = screen
+        self.setScreen(screen)
+        overlay.views.append(self)
+        self.fit()
+
+    @property
+    def offset(self):
+        return self.geometry().topLeft() - self.overlay.pos()
+
+    def fit(self):
+        overlay = self.overlay
+        screen_rect = self.target_screen.geometry().translated(-overlay.pos())
+        if overlay._grabbing_mouse:
+            rect = screen_rect
+        else:
+            ink = (overlay.shown_final.rect or QRect()).united(
+                overlay.current_wet.rect,
+            )
+            rect = QRect()
+            if not ink.isEmpty():
+                keys = list(tile_keys(ink))
+                rect = tile_rect(keys[0]).united(tile_rect(keys[-1]))
+            rect = rect.intersected(screen_rect)
+        if rect.isEmpty():
+            self.hide()
+            return
+        geometry = rect.translated(overlay.pos())
+        if geometry != self.geometry():
+            self.setGeometry(geometry)
+        self.show()
+
+    def close_view(self):
+        self.overlay.views.remove(self)
+        self.deleteLater()
+
+    def paintEvent(self, e):
+        self.overlay.paint_picture(self, e.region(), self.offset)
+
+    def tabletEvent(self, e):
+        self.overlay.tablet_input(e, e.posF() + QPointF(self.offset))
+
+    def mousePressEvent(self, e):
+        self.overlay.queue_input(e, True, e.localPos() + QPointF(self.offset))
+
+    def mouseMoveEvent(self, e):
+        self.overlay.queue_input(e, False, e.localPos() + QPointF(self.offset))
+
+    def mouseReleaseEvent(self, e):
+        self.overlay.release_input()
+
 class Tool:
     name = 'tool'
+    scale = 1
 
     def __init__(self):
-        self.pen = QPen(
-            QColor(0, 0, 0, 0),
-            0,
-            Qt.SolidLine,
-            Qt.RoundCap,
-            Qt.BevelJoin,
-        )
-        self.set_size(1)
-
-    def set_size(self, size):
-        self.size = size
-        self.alpha = 255
-        if size < 1:
-            self.alpha = int(255 * size)
-            self.size = 1
-        self.pen.setWidth(self.size)
-        color = self.pen.color()
-        color.setAlpha(self.alpha)
-        self.pen.setColor(color)
-
-    def draw(self, last, now, update_rect, scribbles, wet):
-        for overlay in scribbles[-1], wet:
-            if overlay:
-                overlay.reserve(update_rect)
-                with overlay.painter_context() as painter:
-                    painter.setPen(self.pen)
-                    painter.setRenderHint(QPainter.Antialiasing)
-                    painter.drawLine(last, now)
+        self.color = QColor(0, 0, 0)
+
+    def outline(self, samples):
+        # Outline of `samples` (rows of a Stroke), to fill in one call
+        widths = samples[:, 2] * self.scale
+        color = QColor(self.color)
+        color.setAlpha(int(255 * min(widths.max(), 1)))
+        outline = stroke_outline(samples[:, :2], np.maximum(widths, 1) / 2)
+        polygon = QPolygonF([QPointF(x, y) for x, y in outline.tolist()])
+        left, top = np.floor(outline.min(axis=0)).astype(int) - 1
+        right, bottom = np.ceil(outline.max(axis=0)).astype(int) + 1
+        rect = QRect(left, top, right - left + 1, bottom - top + 1)
+        return rect, color, polygon
+
+    def paint(self, overlay, rect, color, polygon):
+        overlay.reserve(rect)
+        with STATS.timed('tool_paint_us'):
+            with overlay.painter_context(rect) as painter:
+                painter.setPen(Qt.NoPen)
+                painter.setBrush(color)
+                painter.setRenderHint(QPainter.Antialiasing)
+                painter.drawPolygon(polygon, Qt.WindingFill)
 
 
 class Marker(Tool):
     name = 'Marker'
-    def set_size(self, size):
-        super().set_size(size * MAX_RADIUS / 10)
+    scale = MAX_RADIUS / 10
 
 
 class ColorMarker(Tool):
     name = 'Color Marker'
+    scale = MAX_RADIUS / 5
     def __init__(self, r, g, b, name=None):
         super().__init__()
-        self.pen.setColor(QColor(int(r*255), int(g*255), int(b*255)))
+        self.color = QColor(int(r*255), int(g*255), int(b*255))
         if name:
             self.name = f'{name} Marker'
 
-    def set_size(self, size):
-        super().set_size(size * MAX_RADIUS / 5)
-
 
 class Highlighter(Tool):
     name = 'Highlighter'
-    def set_size(self, size):
-        self.pen.setColor(QColor(255, 250, 0, 255))
-        super().set_size(size * MAX_RADIUS / 2)
+    scale = MAX_RADIUS / 2
+    def __init__(self):
+        super().__init__()
+        self.color = QColor(255, 250, 0)
+
+
+class StrokeEraser(Tool):
+    # Not drawn; removes whole scribbles (OverlayWidget.erase_strokes)
+    name = 'Stroke Eraser'
+    scale = MAX_RADIUS / 5
 
 
 class Eraser(Tool):
     name = 'Eraser'
-    def set_size(self, size):
-        super().set_size(size * MAX_RADIUS)
-        self.pen.setColor(QColor(255, 255, 255, 255))
+    scale = MAX_RADIUS
+    def __init__(self):
+        super().__init__()
+        self.color = QColor(255, 255, 255)
+
+    def paint(self, overlay, rect, color, polygon):
+        overlay.set_blending(QPainter.CompositionMode_DestinationOut, 1)
+        super().paint(overlay, rect, color, polygon)
+
+
+TOOLS = [
+    Marker(),
+    Highlighter(),
+    Eraser(),
+    *(ColorMarker(*color, name) for name, color in COLORS.items()),
+    StrokeEraser(),
+]
+for i, tool in enumerate(TOOLS):
+    tool.id = i
+TOOLS_BY_NAME = {tool.name: tool for tool in TOOLS}
+
+
+# Sessions are append-only files: SESSION_MAGIC, then records of a
+# type byte, payload length and payload. POINTS records extend the
+# stroke of the latest STROKE record.
+SESSION_MAGIC = b'pointout-session 1\n'
+SESSION_RECORD = struct.Struct('<BI')
+SESSION_MS = 1000
+BROADCAST_NAME = 'pointout'
+(
+    SESSION_PICTURE,  # picture id, row
+    SESSION_SELECT,  # picture id
+    SESSION_TOOL,  # tool id, or -1 for none
+    SESSION_STROKE,  # picture id, tool id; pushed at the current index
+    SESSION_POINTS,  # Stroke points
+    SESSION_INDEX,  # picture id, undo stack index
+    SESSION_ERASE,  # picture id, gesture, indices of erased scribbles
+    SESSION_TAIL,  # newest sample held back from Stroke points, if any
+) = range(8)
+SESSION_PAYLOADS = {
+    SESSION_PICTURE: struct.Struct('<II'),
+    SESSION_SELECT: struct.Struct('<I'),
+    SESSION_TOOL: struct.Struct('<h'),
+    SESSION_STROKE: struct.Struct('<IH'),
+    SESSION_INDEX: struct.Struct('<II'),
+    SESSION_ERASE: struct.Struct('<II'),  # followed by uint32 indices
+}
 
-    def draw(self, last, now, update_rect, scribbles, wet):
-        overlay = scribbles[-1]
-        overlay.composition_mode = QPainter.CompositionMode_DestinationOut
-        overlay.opacity = 1
-        super().draw(last, now, update_rect, scribbles, wet)
+def pack_session_record(kind, *values):
+    if kind in (SESSION_POINTS, SESSION_TAIL):
+        payload, = values
+    elif kind == SESSION_ERASE:
+        picture_id, gesture, indices = values
+        payload = (
+            SESSION_PAYLOADS[kind].pack(picture_id, gesture)
+            + array.array('I', indices).tobytes()
+        )
+    else:
+        payload = SESSION_PAYLOADS[kind].pack(*values)
+    return SESSION_RECORD.pack(kind, len(payload)) + payload
+
+def unpack_session_record(kind, payload):
+    # Returns (kind, values), or None for a kind this version doesn't know
+    if kind in (SESSION_POINTS, SESSION_TAIL):
+        return kind, (payload,)
+    elif kind == SESSION_ERASE:
+        header = SESSION_PAYLOADS[kind]
+        indices = array.array('I', payload[header.size:])
+        return kind, (*header.unpack(payload[:header.size]), list(indices))
+    elif kind in SESSION_PAYLOADS:
+        return kind, SESSION_PAYLOADS[kind].unpack(payload)
+
+def read_session_records(file):
+    # Yields (kind, values); a record cut short by a crash ends the session
+    if file.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+        raise ValueError('not a pointout session')
+    while True:
+        header = file.read(SESSION_RECORD.size)
+        if len(header) < SESSION_RECORD.size:
+            return
+        kind, length = SESSION_RECORD.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length:
+            return
+        record = unpack_session_record(kind, payload)
+        if record:
+            yield record
+
+def split_session_records(data):
+    # Returns the complete records at the start of `data`, and their size
+    records = []
+    offset = 0
+    while offset + SESSION_RECORD.size <= len(data):
+        kind, length = SESSION_RECORD.unpack_from(data, offset)
+        start = offset + SESSION_RECORD.size
+        if start + length > len(data):
+            break
+        record = unpack_session_record(kind, bytes(data[start:start + length]))
+        if record:
+            records.append(record)
+        offset = start + length
+    return records, offset
+
+class SessionWriter:
+    # Appends changes to the widget's pictures to a session file, or any
+    # object with write(), flush() and close(). Samples of the stroke being
+    # drawn are written every `interval` ms.
+    def __init__(self, widget, file, interval=SESSION_MS):
+        self.widget = widget
+        self.file = file
+        self.stroke = None
+        self.saved_points = 0
+        self.saved_tail = b''
+        self.connections = []
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.sync)
+        self.timer.start(interval)
+        self.connect(widget.selection_model.currentChanged, self.picture_selected)
+
+    def connect(self, signal, slot):
+        signal.connect(slot)
+        self.connections.append((signal, slot))
+
+    def write(self, kind, *values):
+        self.file.write(pack_session_record(kind, *values))
+
+    def write_all(self):
+        # Writes the widget's current state, as for a new file
+        self.file.write(SESSION_MAGIC)
+        widget = self.widget
+        self.stroke = None
+        self.saved_tail = b''
+        for row in range(widget.picture_model.rowCount()):
+            picture = widget.picture_model.item(row)
+            self.picture_added(picture)
+            stack = picture.undo_stack
+            for i in range(stack.count()):
+                command = stack.command(i)
+                if isinstance(command, EraseStrokesCommand):
+                    for indices, erased in command.steps:
+                        self.write(
+                            SESSION_ERASE, picture.id, command.gesture, indices,
+                        )
+                    continue
+                self.write(SESSION_STROKE, picture.id, command.tool.id)
+                self.write(SESSION_POINTS, command.stroke.points.tobytes())
+                self.stroke = command.stroke
+            self.write(SESSION_INDEX, picture.id, stack.index())
+        # Keep following the stroke being drawn, if records for it would
+        # still go to it
+        if self.stroke is not widget.drawn_stroke:
+            self.stroke = None
+        elif self.stroke is not None:
+            self.saved_points = len(self.stroke.points)
+        self.picture_selected()
+        self.tool_changed(widget.tool)
+        self.sync()
+
+    def picture_added(self, picture):
+        self.write(SESSION_PICTURE, picture.id, picture.row())
+        self.connect(
+            picture.undo_stack.indexChanged,
+            lambda index: self.write(SESSION_INDEX, picture.id, index),
+        )
+
+    def picture_selected(self):
+        if self.widget.picture:
+            self.write(SESSION_SELECT, self.widget.picture.id)
+
+    def tool_changed(self, tool):
+        self.write(SESSION_TOOL, -1 if tool is None else tool.id)
+
+    def stroke_started(self, picture, command):
+        self.save_points()
+        self.write(SESSION_STROKE, picture.id, command.tool.id)
+        self.stroke = command.stroke
+        self.saved_points = 0
 
+    def strokes_erased(self, picture, gesture, indices):
+        self.save_points()
+        self.write(SESSION_ERASE, picture.id, gesture, indices)
+
+    def save_points(self):
+        if self.stroke and len(self.stroke.points) > self.saved_points:
+            self.write(
+                SESSION_POINTS, self.stroke.points[self.saved_points:].tobytes(),
+            )
+            self.saved_points = len(self.stroke.points)
+        # The newest sample held back for simplification goes as it is,
+        # without being kept in the stroke
+        tail = b''
+        if self.stroke:
+            tail = self.stroke.tail[-STROKE_FIELDS:].tobytes()
+        if tail != self.saved_tail:
+            self.write(SESSION_TAIL, tail)
+            self.saved_tail = tail
+
+    def sync(self):
+        self.save_points()
+        self.file.flush()
+
+    def close(self):
+        self.timer.stop()
+        if self in self.widget.sessions:
+            self.widget.sessions.remove(self)
+        for sender, slot in self.connections:
+            sender.disconnect(slot)
+        self.sync()
+        self.file.close()
+
+class SessionLoader:
+    # Replaces the widget's pictures with ones rebuilt from session records.
+    # Until finish(), records are applied quietly and strokes are left to
+    # be rasterized when first needed; after it (in a viewer following a
+    # broadcast) each record shows up as it is applied.
+    def __init__(self, widget):
+        self.widget = widget
+        widget.selection_model.blockSignals(True)
+        for row in range(widget.picture_model.rowCount()):
+            widget.undo_group.removeStack(
+                widget.picture_model.item(row).undo_stack,
+            )
+        widget.picture_model.removeRows(0, widget.picture_model.rowCount())
+        widget.recent_pictures = []
+        self.pictures = {}
+        self.command = None
+        self.selected = None
+        self.gesture = -1
+        self.finished = False
+
+    def apply(self, kind, values):
+        widget = self.widget
+        if kind == SESSION_PICTURE:
+            picture_id, row = values
+            picture = self.pictures[picture_id] = PictureItem(widget)
+            picture.id = picture_id
+            picture.undo_stack.blockSignals(not self.finished)
+            widget.picture_model.insertRow(row, picture)
+            if self.finished:
+                picture.reset_props()
+        elif kind == SESSION_SELECT:
+            self.selected, = values
+            if self.finished:
+                self.select()
+        elif kind == SESSION_TOOL:
+            tool_id, = values
+            widget.tool = None if tool_id < 0 else TOOLS[tool_id]
+        elif kind == SESSION_STROKE:
+            picture_id, tool_id = values
+            picture = self.pictures[picture_id]
+            self.command = DrawCommand(widget, TOOLS[tool_id], picture.scribbles)
+            self.command.scribble.drop_raster()
+            picture.undo_stack.push(self.command)
+            self.picture = picture
+        elif kind in (SESSION_POINTS, SESSION_TAIL):
+            stroke = self.command.stroke
+            samples = array.array('d', values[0])
+            if kind == SESSION_POINTS:
+                stroke.points.extend(samples)
+                self.picture.stroke_index.add(self.command.scribble)
+            else:
+                stroke.tail = samples
+            if self.finished:
+                self.draw_samples(samples)
+        elif kind == SESSION_ERASE:
+            picture_id, self.gesture, indices = values
+            picture = self.pictures[picture_id]
+            picture.undo_stack.push(EraseStrokesCommand(
+                widget, picture.scribbles,
+                [picture.scribbles[i] for i in indices], self.gesture,
+            ))
+        elif kind == SESSION_INDEX:
+            picture_id, index = values
+            self.pictures[picture_id].undo_stack.setIndex(index)
+
+    def draw_samples(self, samples):
+        # Draws the ones not drawn yet, as flush_ink does. Points held
+        # back by the writer are older than a tail sample already drawn.
+        widget = self.widget
+        stroke = self.command.stroke
+        scribble = self.command.scribble
+        drawn = stroke.fresh[3 - STROKE_FIELDS] if stroke.fresh else -1
+        for i in range(0, len(samples), STROKE_FIELDS):
+            if samples[i + 3] > drawn:
+                stroke.fresh.extend(samples[i:i + STROKE_FIELDS])
+        outlines = stroke.fresh_outlines()
+        def job():
+            if scribble._tiles is None:
+                return scribble.ensure_raster()
+            stroke.rasterize(scribble, outlines)
+        widget.renderer.submit(job, stroke.mark_rendered)
+        if scribble in widget.scribbles[-1:]:
+            widget.refresh_final()
+
+    def select(self):
+        picture = self.pictures.get(
+            self.selected, self.widget.picture_model.item(0),
+        )
+        self.widget.selection_model.setCurrentIndex(
+            picture.index(), QItemSelectionModel.ClearAndSelect,
+        )
+
+    def finish(self):
+        widget = self.widget
+        widget.picture_ids = itertools.count(max(self.pictures, default=-1) + 1)
+        widget.erase_gestures = itertools.count(self.gesture + 1)
+        widget.selection_model.blockSignals(False)
+        for picture in self.pictures.values():
+            picture.undo_stack.blockSignals(False)
+        if self.pictures:
+            self.select()
+        else:
+            widget.clear(force=True)
+        for picture in self.pictures.values():
+            picture.reset_props()
+        self.finished = True
+
+def load_session(widget, file):
+    loader = SessionLoader(widget)
+    for kind, values in read_session_records(file):
+        loader.apply(kind, values)
+    loader.finish()
+
+def open_session(widget, filename):
+    # Loads the session if there is one, then rewrites it compactly and
+    # keeps appending to it
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            load_session(widget, f)
+    new_filename = filename + '.new'
+    writer = SessionWriter(widget, open(new_filename, 'wb'))
+    writer.write_all()
+    os.replace(new_filename, filename)
+    widget.sessions.append(writer)
+    return writer
+
+class SocketFile:
+    # File-like writes to a QLocalSocket, for SessionWriter
+    def __init__(self, socket):
+        self.socket = socket
+
+    def write(self, data):
+        self.socket.write(data)
+
+    def flush(self):
+        self.socket.flush()
+
+    def close(self):
+        self.socket.deleteLater()
+
+class Broadcaster:
+    # Streams session records to viewers connecting to a local socket:
+    # the current pictures first, then each change, with new samples of
+    # the stroke being drawn sent every frame
+    def __init__(self, widget, name=BROADCAST_NAME):
+        from PySide6.QtNetwork import QLocalServer
+        self.widget = widget
+        self.server = QLocalServer()
+        QLocalServer.removeServer(name)
+        if not self.server.listen(name):
+            raise OSError(self.server.errorString())
+        self.server.newConnection.connect(self.viewer_connected)
+
+    def viewer_connected(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            writer = SessionWriter(
+                self.widget, SocketFile(socket), interval=FRAME_MS,
+            )
+            writer.write_all()
+            self.widget.sessions.append(writer)
+            socket.disconnected.connect(
+                functools.partial(self.viewer_disconnected, writer),
+            )
+
+    def viewer_disconnected(self, writer):
+        if writer in self.widget.sessions:
+            writer.close()
+
+    def close(self):
+        for writer in list(self.widget.sessions):
+            if isinstance(writer.file, SocketFile):
+                self.viewer_disconnected(writer)
+        self.server.close()
+
+def vector_paths(scribbles):
+    # The picture as (path, color, opacity) to fill in order. Scribbles
+    # with an eraser cut their outlines out of the paths under them.
+    items = []
+    for scribble in scribbles:
+        outlines = scribble.stroke.outlines()
+        if any(isinstance(tool, Eraser) for tool, *_ in outlines):
+            for tool, rect, color, polygon in outlines:
+                erased = QPainterPath()
+                erased.addPolygon(polygon)
+                items = [
+                    (path.subtracted(erased), color, opacity)
+                    if path.controlPointRect().intersects(rect) else
+                    (path, color, opacity)
+                    for path, color, opacity in items
+                ]
+        else:
+            for tool, rect, color, polygon in outlines:
+                path = QPainterPath()
+                path.setFillRule(Qt.WindingFill)
+                path.addPolygon(polygon)
+                items.append((path, color, scribble.opacity))
+    return items
+
+def vector_rect(items):
+    rect = QRectF()
+    for path, color, opacity in items:
+        rect = rect.united(path.boundingRect())
+    return rect.toAlignedRect()
+
+def paint_vector(painter, items):
+    painter.setPen(Qt.NoPen)
+    painter.setRenderHint(QPainter.Antialiasing)
+    for path, color, opacity in items:
+        painter.setOpacity(opacity)
+        painter.fillPath(path, color)
+
+def png_chunk(kind, data):
+    return (
+        struct.pack('>I', len(data)) + kind + data
+        + struct.pack('>I', zlib.crc32(kind + data))
+    )
+
+def export_png(final, rect, file):
+    # Composites `rect` of a final one band of TILE_SIZE rows at a time
+    # and compresses the band's rows straight into the file
+    width, height = rect.width(), rect.height()
+    file.write(b'\x89PNG\r\n\x1a\n')
+    file.write(png_chunk(
+        b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0),
+    ))
+    compressor = zlib.compressobj()
+    band = QImage(width, TILE_SIZE, QImage.Format_RGBA8888)
+    for top in range(rect.top(), rect.top() + height, TILE_SIZE):
+        rows = min(TILE_SIZE, rect.top() + height - top)
+        band.fill(QColor(0, 0, 0, 0))
+        painter = QPainter(band)
+        painter.translate(-rect.left(), -top)
+        final.paint(painter, QRect(rect.left(), top, width, rows))
+        painter.end()
+        bits = band.constBits()
+        line = band.bytesPerLine()
+        data = compressor.compress(b''.join(
+            b'\0' + bits[y * line:y * line + width * 4] for y in range(rows)
+        ))
+        if data:
+            file.write(png_chunk(b'IDAT', data))
+    file.write(png_chunk(b'IDAT', compressor.flush()))
+    file.write(png_chunk(b'IEND', b''))
+
+def export_svg(items, rect, filename):
+    from PySide6.QtSvg import QSvgGenerator
+    generator = QSvgGenerator()
+    generator.setFileName(filename)
+    generator.setSize(rect.size())
+    generator.setViewBox(rect)
+    painter = QPainter(generator)
+    paint_vector(painter, items)
+    painter.end()
+
+def export_pdf(pages, rect, filename):
+    # One page per list of vector_paths, in pixels as points
+    writer = QPdfWriter(filename)
+    writer.setResolution(72)
+    writer.setPageSize(QPageSize(QSizeF(rect.size()), QPageSize.Point))
+    writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+    painter = QPainter(writer)
+    for i, items in enumerate(pages):
+        if i:
+            writer.newPage()
+        painter.save()
+        painter.translate(-rect.topLeft())
+        paint_vector(painter, items)
+        painter.restore()
+    painter.end()
+
+def export_pictures(pictures, filename, rect=None):
+    # Writes the pictures' current states: PNG and SVG take one picture,
+    # PDF gets a page for each. `rect` defaults to the bounds of the ink.
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.png':
+        picture, = pictures
+        final = picture.scribbles[-1].final if picture.scribbles else Overlay()
+        with open(filename, 'wb') as f:
+            export_png(final, rect or final.rect or QRect(0, 0, 1, 1), f)
+        return
+    pages = [vector_paths(picture.scribbles) for picture in pictures]
+    if rect is None:
+        rect = QRect()
+        for items in pages:
+            rect = rect.united(vector_rect(items))
+        if rect.isEmpty():
+            rect = QRect(0, 0, 1, 1)
+    if extension == '.svg':
+        items, = pages
+        export_svg(items, rect, filename)
+    elif extension == '.pdf':
+        export_pdf(pages, rect, filename)
+    else:
+        raise ValueError(f'cannot export to {extension or filename}')
 
 class WidgetFinder:
     def __init__(self, obj):
@@ -544,15 +2511,16 @@ def make_toolbox_window(overlay_widget):
 
     layout = add_layout()
 
-    for text, shortcut, tool, activate in (
-        ("&Disable", "D", None, False),
-        ("&Marker", "M", Marker(), True),
-        ("&Hilite", "H", Highlighter(), False),
-        ("&Eraser", "E", Eraser(), False),
+    for text, shortcut, tool in (
+        ("&Disable", "D", None),
+        ("&Marker", "M", TOOLS_BY_NAME['Marker']),
+        ("&Hilite", "H", TOOLS_BY_NAME['Highlighter']),
+        ("&Eraser", "E", TOOLS_BY_NAME['Eraser']),
+        ("&Strokes", "S", TOOLS_BY_NAME['Stroke Eraser']),
     ):
         btn = make_tool_button(text, shortcut)
         layout.addWidget(btn)
-        if activate:
+        if tool is overlay_widget.tool:
             btn.setChecked(True)
         window.shortcut_to_action[shortcut] = btn.click
         btn.clicked.connect(tool_setter(tool))
@@ -560,13 +2528,15 @@ def make_toolbox_window(overlay_widget):
     layout = add_layout()
 
     for i, (name, color) in enumerate(COLORS.items(), 1):
-        tool = ColorMarker(*color, name)
+        tool = TOOLS_BY_NAME[f'{name} Marker']
         btn = make_tool_button(str(i), str(i))
         btn.setStyleSheet("background-color: rgb({}, {}, {});".format(
             *[c*255 for c in color])
         )
         layout.addWidget(btn)
         btn.setToolTip(name)
+        if tool is overlay_widget.tool:
+            btn.setChecked(True)
         window.shortcut_to_action[str(i)] = btn.click
         btn.clicked.connect(tool_setter(tool))
 
@@ -603,28 +2573,130 @@ def make_toolbox_window(overlay_widget):
     clr = add_action('Clear', overlay_widget.clear, 'document-new-symbolic', 'Q')
     overlay_widget.can_clear_changed.connect(clr.setEnabled)
     clr.setEnabled(overlay_widget.can_clear)
+    def export():
+        filename, _ = QFileDialog.getSaveFileName(
+            window, 'Export picture', 'pointout.png',
+            'Images (*.png *.svg *.pdf)',
+        )
+        if filename:
+            picture = overlay_widget.picture
+            overlay_widget.renderer.submit(
+                functools.partial(export_pictures, [picture], filename),
+            )
+    add_action('Export', export, 'document-save-as-symbolic')
+    window.stats_window = None
+    def show_stats():
+        if window.stats_window is None:
+            window.stats_window = make_stats_window(overlay_widget)
+        window.stats_window.show()
+    add_action('Stats', show_stats, 'utilities-system-monitor-symbolic')
     toolbar.addSeparator()
     add_action('Close', sys.exit, 'process-stop-symbolic')
 
+    # The picture list and undo history are added in the event loop pass
+    # after the toolbox is first shown, so input isn't held up by both
     layout = add_layout()
-    ilv = QListView()
-    ilv.setModel(overlay_widget.picture_model)
-    ilv.setSelectionModel(overlay_widget.selection_model)
-    layout.addWidget(ilv)
-    layout.addWidget(QUndoView(overlay_widget.undo_group))
+    def add_history():
+        if not layout.count():
+            ilv = QListView()
+            ilv.setModel(overlay_widget.picture_model)
+            ilv.setSelectionModel(overlay_widget.selection_model)
+            ilv.setIconSize(thumbnail_size(overlay_widget.size()))
+            layout.addWidget(ilv)
+            layout.addWidget(QUndoView(overlay_widget.undo_group))
+    def show():
+        window.show()
+        QTimer.singleShot(0, add_history)
+    window.show_with_history = show
 
     return window
 
-def make_overlay_widget():
-    w = OverlayWidget()
+def format_stats(stats):
+    lines = []
+    for name, h in stats['histograms'].items():
+        lines.append(
+            f"{name:>16}: {h['count']:7} × mean {h['mean']:9.1f}"
+            + f" p95 {h['p95']:9.1f} max {h['max']:9.1f} {h['unit']}"
+        )
+    cache = stats['final_cache']
+    lines.append(
+        f"{'final cache':>16}: {cache['bytes'] / 2**20:7.1f} MiB,"
+        + f" {cache['finals']} finals, {cache['hits']} hits,"
+        + f" {cache['misses']} misses, {cache['evictions']} evictions"
+    )
+    rasters = stats['raster_cache']
+    lines.append(
+        f"{'raster cache':>16}: {rasters['bytes'] / 2**20:7.1f} MiB,"
+        + f" {rasters['rasters']} rasters, {rasters['evictions']} evictions"
+    )
+    for picture in stats['pictures']:
+        lines.append(
+            f"{picture['name']:>16}: {picture['raster_bytes'] / 2**20:7.1f}"
+            + f" MiB rasters, {picture['final_bytes'] / 2**20:.1f} MiB finals,"
+            + f" {picture['stroke_bytes'] / 1024:.1f} KiB strokes"
+        )
+    return '\n'.join(lines)
+
+def make_stats_window(overlay_widget):
+    window = QWidget()
+    window.setWindowTitle('Pointout statistics')
+    layout = QVBoxLayout()
+    window.setLayout(layout)
+    text = QPlainTextEdit()
+    text.setReadOnly(True)
+    text.setLineWrapMode(QPlainTextEdit.NoWrap)
+    layout.addWidget(text)
+    export_button = QToolButton()
+    export_button.setText('Export JSON…')
+    layout.addWidget(export_button)
+
+    def refresh():
+        if window.isVisible():
+            overlay_widget.collect_stats(
+                lambda stats: text.setPlainText(format_stats(stats)),
+            )
+
+    def export():
+        filename, _ = QFileDialog.getSaveFileName(
+            window, 'Export statistics', 'pointout-stats.json', 'JSON (*.json)',
+        )
+        if filename:
+            def write(stats):
+                with open(filename, 'w') as f:
+                    json.dump(stats, f, indent=2)
+            overlay_widget.collect_stats(write)
+
+    export_button.clicked.connect(export)
+    window.refresh_timer = QTimer(window)
+    window.refresh_timer.timeout.connect(refresh)
+    window.refresh_timer.start(STATS_MS)
+    window.resize(640, 320)
+    return window
+
+def make_overlay_widget(renderer=None):
+    # The OverlayWidget spans the desktop but isn't shown; each screen
+    # gets a ScreenView of it
+    w = OverlayWidget(renderer)
+    desktop = QRect()
+    for screen in app.screens():
+        desktop = desktop.united(screen.geometry())
+    w.setGeometry(desktop)
 
+    w.pen_screen = app.primaryScreen()
     for screen in reversed(app.screens()):
-        print(screen.manufacturer())
         if screen.manufacturer().startswith(('Wacom', 'Chimei')):
-            geom = screen.geometry()
-            w.move(geom.left(), geom.top())
-            w.resize(geom.width(), geom.height())
-
+            w.pen_screen = screen
+    TRACE('input', INFO, 'pen-screen', app.screens().index(w.pen_screen))
+
+    def screen_removed(screen):
+        for view in list(w.views):
+            if view.target_screen is screen:
+                view.close_view()
+
+    for screen in app.screens():
+        ScreenView(w, screen)
+    app.screenAdded.connect(lambda screen: ScreenView(w, screen))
+    app.screenRemoved.connect(screen_removed)
     return w
 
 class Application(QApplication):
@@ -642,64 +2714,523 @@ class Application(QApplication):
         self._timer.start(100)
 
     def event(self, e):
-        print(e)
+        if TRACE.input <= DEBUG:
+            TRACE('input', DEBUG, 'app-event', e.type().value)
         if e.type() == QEvent.TabletEnterProximity:
-            print('enter', toolbox.geometry(), QCursor.pos())
-            if toolbox.geometry().contains(QCursor.pos()):
+            pos = QCursor.pos()
+            TRACE('input', INFO, 'proximity-enter', pos.x(), pos.y())
+            if toolbox.geometry().contains(pos):
                 return False
             overlay_widget.update_grab(True)
             return True
         elif e.type() == QEvent.TabletLeaveProximity:
-            print('leave')
+            TRACE('input', INFO, 'proximity-leave')
             overlay_widget.update_grab(False)
             return True
         elif e.type() == QEvent.TabletTrackingChange:
-            print('track')
+            TRACE('input', INFO, 'tracking-change')
             return True
-        elif e.type() == QEvent.User:
-            print('app handling', e.key)
-            try:
-                act = toolbox.shortcut_to_action[e.key]
-            except KeyError:
-                print(f'no {e.key}...')
-            else:
-                print(act)
-                act()
         return False
 
 
-def watch_shortcuts(app, widget):
-    def post(key):
-        app.postEvent(app, MyEvent(key))
-    global_shortcuts.watch_shortcuts(post)
+# Global shortcuts are these keys with GLOBAL_MODIFIERS held
+GLOBAL_MODIFIERS = (
+    global_shortcuts.CONTROL | global_shortcuts.SHIFT
+    | global_shortcuts.ALT | global_shortcuts.SUPER
+)
+X_KEYSYMS = {'Esc': 'Escape'}
+
+def global_keymap(shortcut_to_action, modifiers=GLOBAL_MODIFIERS):
+    # Returns the keymap for global_shortcuts.connect, and the actions
+    # indexed by the ids it will pass to the callback
+    keymap = []
+    actions = []
+    for key, action in shortcut_to_action.items():
+        keymap.append((X_KEYSYMS.get(key, key), modifiers, len(actions)))
+        actions.append(action)
+    return keymap, actions
+
+def watch_shortcuts(app, shortcut_to_action):
+    # Shortcuts arrive on the X connection; read them from the event loop
+    keymap, actions = global_keymap(shortcut_to_action)
+    def activate(i):
+        TRACE('shortcuts', INFO, 'shortcut', i)
+        actions[i]()
+    fd = global_shortcuts.connect(keymap, activate)
+    notifier = QSocketNotifier(fd, QSocketNotifier.Read, app)
+    notifier.activated.connect(lambda: global_shortcuts.process_events())
+    app.aboutToQuit.connect(global_shortcuts.disconnect)
+    global_shortcuts.process_events()
+    return notifier
+
+def synthetic_events(scenario, width, height, seed=0):
+    # Events are the ones OverlayWidget.input_log records:
+    # ('press', x, y), ('move', x, y, pressure, erase),
+    # ('undo',), ('redo',), ('clear',) and ('switch', picture_row)
+    import random
+    rng = random.Random(seed)
+
+    def line(x0, y0, x1, y1, samples, erase=False):
+        yield 'press', x0, y0
+        for i in range(1, samples + 1):
+            t = i / samples
+            yield (
+                'move', x0 + (x1 - x0) * t, y0 + (y1 - y0) * t,
+                0.3 + 0.6 * math.sin(t * math.pi), erase,
+            )
 
-class MyEvent(QEvent):
-    def __init__(self, key):
-        super().__init__(QEvent.User)
-        self.key = key
+    def scribble(samples, erase=False):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        angle = rng.uniform(0, 2 * math.pi)
+        yield 'press', x, y
+        for i in range(samples):
+            angle += rng.gauss(0, 0.3)
+            x = min(max(x + 6 * math.cos(angle), 0), width)
+            y = min(max(y + 6 * math.sin(angle), 0), height)
+            yield 'move', x, y, rng.uniform(0.2, 1), erase
+
+    if scenario == 'long-lines':
+        for i in range(20):
+            yield from line(
+                0, i * height / 20, width, height - i * height / 20, 400,
+            )
+    elif scenario == 'scribbles':
+        for i in range(50):
+            yield from scribble(150)
+    elif scenario == 'eraser':
+        for i in range(20):
+            yield from scribble(150)
+        for i in range(10):
+            yield from line(
+                0, rng.uniform(0, height), width, rng.uniform(0, height), 200,
+                erase=True,
+            )
+    elif scenario == 'many-strokes':
+        for i in range(500):
+            yield from scribble(20)
+    elif scenario == 'undo-storm':
+        for i in range(100):
+            yield from scribble(40)
+        for i in range(10):
+            yield from [('undo',)] * 100
+            yield from [('redo',)] * 100
+    elif scenario == 'pictures':
+        for picture in range(5):
+            if picture:
+                yield 'clear',
+            for i in range(30):
+                yield from scribble(40)
+        for i in range(50):
+            yield 'switch', rng.randrange(5)
+    else:
+        raise ValueError(f'unknown scenario: {scenario}')
+
+BENCH_SCENARIOS = (
+    'long-lines', 'scribbles', 'eraser', 'many-strokes', 'undo-storm',
+    'pictures',
+)
+# Launching pointout until it takes input must stay under this
+STARTUP_BUDGET_MS = 750
+
+def tile_bytes(widget):
+    tiles = {}
+    def add(overlay):
+        if overlay and overlay._tiles:
+            tiles.update((id(t), t) for t in overlay._tiles.values())
+    for row in range(widget.picture_model.rowCount()):
+        picture = widget.picture_model.item(row)
+        for scribble in picture.all_scribbles():
+            add(scribble)
+            add(scribble._final)
+    add(widget.shown_final)
+    return len(tiles) * TILE_BYTES
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def bench_replay(widget, events, samples_per_frame=4):
+    # Feeds events as a 200 Hz pen would, running one frame per
+    # `samples_per_frame` samples, and times each frame and the repaint
+    # of its damage
+    import resource
+    sample_times = []
+    paint_times = []
+    event_ms = 0
+    pending = 0
+
+    def frame():
+        nonlocal pending
+        start = time.perf_counter()
+        widget.frame_update()
+        widget.renderer.wait()
+        if pending:
+            sample_times.extend([(time.perf_counter() - start) / pending] * pending)
+        pending = 0
+        start = time.perf_counter()
+        QApplication.processEvents()
+        paint_times.append(time.perf_counter() - start)
+
+    for event in events:
+        op, *args = event
+        if op in ('press', 'move'):
+            event_ms += 5
+            if op == 'press':
+                x, y = args
+                widget.input_queue.push(event_ms, True, QPointF(x, y))
+            else:
+                x, y, pressure, erase = args
+                widget.input_queue.push(
+                    event_ms, False, QPointF(x, y), pressure, erase,
+                )
+            pending += 1
+            if pending >= samples_per_frame:
+                frame()
+            continue
+        frame()
+        if op == 'undo':
+            widget.undo()
+        elif op == 'redo':
+            widget.redo()
+        elif op == 'clear':
+            widget.clear()
+        elif op == 'switch':
+            row, = args
+            index = widget.picture_model.index(
+                min(row, widget.picture_model.rowCount() - 1), 0,
+            )
+            widget.selection_model.setCurrentIndex(
+                index, QItemSelectionModel.ClearAndSelect,
+            )
+        frame()
+    frame()
+    return {
+        'samples': len(sample_times),
+        'sample_us_mean': sum(sample_times) / max(len(sample_times), 1) * 1e6,
+        'sample_us_p95': percentile(sample_times, 0.95) * 1e6,
+        'frames': len(paint_times),
+        'paint_ms_mean': sum(paint_times) / max(len(paint_times), 1) * 1e3,
+        'paint_ms_p95': percentile(paint_times, 0.95) * 1e3,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'tile_mib': tile_bytes(widget) / 2**20,
+    }
+
+def bench_startup(runs):
+    # Launches pointout `runs` times; returns the median milliseconds
+    # until the overlay takes input and until the toolbox is complete
+    import subprocess
+    times = collections.defaultdict(list)
+    for i in range(runs):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'import pointout; pointout.main()',
+             '--quit-when-ready', '--no-shortcuts'],
+            stdout=subprocess.PIPE, text=True,
+        )
+        for line in process.stdout:
+            if line.strip() in ('overlay', 'toolbox'):
+                times[line.strip()].append(
+                    (time.perf_counter() - start) * 1e3,
+                )
+        if process.wait():
+            raise RuntimeError(f'pointout exited with {process.returncode}')
+    return {f'{name}_ms': percentile(t, 0.5) for name, t in times.items()}
+
+def bench_main():
+    global TILE_IMAGES
+    parser = argparse.ArgumentParser(
+        description='Replay strokes through the drawing pipeline headlessly',
+    )
+    parser.add_argument(
+        'scenarios', nargs='*', metavar='SCENARIO',
+        help='synthetic scenarios to run: ' + ', '.join(BENCH_SCENARIOS),
+    )
+    parser.add_argument(
+        '--events', action='append', default=[], metavar='FILE',
+        help='replay events recorded with --record-input',
+    )
+    parser.add_argument('--size', default='3840x2160')
+    parser.add_argument('--render-thread', action='store_true')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument(
+        '--startup', type=int, metavar='RUNS',
+        help='time launching pointout instead, failing over --budget',
+    )
+    parser.add_argument(
+        '--budget', type=float, default=STARTUP_BUDGET_MS, metavar='MS',
+    )
+    args = parser.parse_args()
+    width, height = (int(n) for n in args.size.split('x'))
+
+    if args.startup:
+        result = bench_startup(args.startup)
+        if args.json:
+            json.dump(result, sys.stdout, indent=2)
+            print()
+        else:
+            for key, value in result.items():
+                print(f'{key:>16}: {value:10.2f}')
+        if result['overlay_ms'] > args.budget:
+            sys.exit(f'startup over budget of {args.budget} ms')
+        return
+
+    runs = [
+        (name, functools.partial(synthetic_events, name, width, height), [name])
+        for name in args.scenarios or ([] if args.events else BENCH_SCENARIOS)
+    ]
+    for filename in args.events:
+        def read_events(filename=filename):
+            with open(filename) as f:
+                for line in f:
+                    yield json.loads(line)
+        runs.append((filename, read_events, ['--events', filename]))
+
+    results = {}
+    if len(runs) > 1:
+        # Peak RSS is the whole process's, so each run gets its own
+        import subprocess
+        for name, events, run_args in runs:
+            output = subprocess.run(
+                [sys.executable, '-c', 'import pointout; pointout.bench_main()',
+                 *run_args, '--size', args.size, '--json',
+                 *(['--render-thread'] if args.render_thread else [])],
+                stdout=subprocess.PIPE, text=True, check=True,
+            ).stdout
+            results.update(json.loads(output))
+            if not args.json:
+                print_bench_result(name, results[name])
+    else:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        app = QApplication(sys.argv[:1])
+        if args.render_thread:
+            TILE_IMAGES = True
+        (name, events, run_args), = runs
+        renderer = ThreadedRenderer() if args.render_thread else None
+        widget = OverlayWidget(renderer)
+        widget.resize(width, height)
+        widget.show()
+        app.processEvents()
+        results[name] = bench_replay(widget, events())
+        widget.close()
+        if not args.json:
+            print_bench_result(name, results[name])
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+def print_bench_result(name, result):
+    print(name)
+    for key, value in result.items():
+        print(f'    {key:>16}: {value:10.2f}')
+
+def view_main():
+    from PySide6.QtNetwork import QLocalSocket
+    parser = argparse.ArgumentParser(
+        description='Show the pictures of a pointout started with --broadcast',
+    )
+    parser.add_argument('name', nargs='?', default=BROADCAST_NAME)
+    parser.add_argument('--size', default='1280x720')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    widget = OverlayWidget()
+    widget.setWindowFlags(Qt.Window)
+    widget.setWindowTitle('pointout viewer')
+    widget.resize(*(int(n) for n in args.size.split('x')))
+    widget.show()
+
+    socket = QLocalSocket()
+    data = bytearray()
+    loader = None
+
+    def read():
+        nonlocal loader
+        data.extend(socket.readAll().data())
+        if loader is None:
+            if len(data) < len(SESSION_MAGIC):
+                return
+            if data[:len(SESSION_MAGIC)] != SESSION_MAGIC:
+                sys.exit('not a pointout broadcast')
+            del data[:len(SESSION_MAGIC)]
+            loader = SessionLoader(widget)
+        records, size = split_session_records(data)
+        del data[:size]
+        for kind, values in records:
+            loader.apply(kind, values)
+        if not loader.finished:
+            loader.finish()
+
+    socket.readyRead.connect(read)
+    socket.errorOccurred.connect(lambda error: sys.exit(socket.errorString()))
+    socket.connectToServer(args.name)
+    sys.exit(app.exec())
 
-    def __repr__(self):
-        return f'my event! {self.key}'
+def export_main():
+    parser = argparse.ArgumentParser(
+        description='Export pictures of a session saved with --session',
+    )
+    parser.add_argument('session')
+    parser.add_argument(
+        'output',
+        help='a .pdf, or .png/.svg; with several pictures, "{}" in the name'
+        + ' is replaced by the picture number',
+    )
+    parser.add_argument(
+        '--picture', type=int, action='append', metavar='N',
+        help='pictures to export, numbered from 1 (default: the selected'
+        + ' one, or all for PDF)',
+    )
+    parser.add_argument('--all', action='store_true')
+    parser.add_argument(
+        '--rect', metavar='X,Y,W,H',
+        help='area to export (default: the bounds of the ink)',
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QApplication(sys.argv[:1])
+    widget = OverlayWidget()
+    with open(args.session, 'rb') as f:
+        load_session(widget, f)
+    model = widget.picture_model
+    if args.picture:
+        numbers = args.picture
+    elif args.all or args.output.lower().endswith('.pdf'):
+        numbers = range(1, model.rowCount() + 1)
+    else:
+        numbers = [widget.picture.row() + 1]
+    pictures = [model.item(n - 1) for n in numbers]
+    rect = QRect(*map(int, args.rect.split(','))) if args.rect else None
+    if args.output.lower().endswith('.pdf') or len(pictures) == 1:
+        export_pictures(pictures, args.output.format(*numbers), rect)
+    else:
+        for n, picture in zip(numbers, pictures):
+            export_pictures([picture], args.output.format(n), rect)
+
+def trace_main():
+    parser = argparse.ArgumentParser(
+        description='Print a trace dumped by pointout --trace-ring',
+    )
+    parser.add_argument('file')
+    args = parser.parse_args()
+    with open(args.file, 'rb') as f:
+        for now, category, level, event, values in read_trace(f):
+            print(f'{now:.6f} {category} {event}', *values)
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1: {text}')
+    return value
 
 def main():
-    global app, toolbox, overlay_widget
-    app = Application(sys.argv)
-
-    overlay_widget = make_overlay_widget()
-
-    overlay_widget.showFullScreen()
+    global app, toolbox, overlay_widget, TILE_IMAGES
+    parser = argparse.ArgumentParser(
+        description='Draw on the screen; other options are passed to Qt',
+    )
+    parser.add_argument(
+        '--trace', metavar='SPEC', help="like 'input:info,paint' or 'all:debug'",
+    )
+    parser.add_argument(
+        '--trace-ring', metavar='FILE',
+        help='keep recent trace events, written to FILE on SIGUSR1 and exit',
+    )
+    parser.add_argument('--render-thread', action='store_true')
+    parser.add_argument(
+        '--record-input', metavar='FILE',
+        help='append input events for pointout-bench --events',
+    )
+    parser.add_argument(
+        '--resident-pictures', type=positive_int, metavar='N',
+        help='pictures that keep their finals and strokes in memory',
+    )
+    parser.add_argument('--final-cache', type=int, metavar='MIB')
+    parser.add_argument('--raster-cache', type=int, metavar='MIB')
+    parser.add_argument(
+        '--predict', type=int, metavar='MS',
+        help='draw ink ahead of the pen by up to MS milliseconds',
+    )
+    parser.add_argument(
+        '--record', metavar='DIR',
+        help='record PNG frames and an ffconcat list into DIR',
+    )
+    parser.add_argument(
+        '--session', metavar='FILE', help='load and keep saving pictures',
+    )
+    parser.add_argument(
+        '--broadcast', metavar='NAME',
+        help='let pointout-view NAME follow the pictures',
+    )
+    parser.add_argument(
+        '--no-shortcuts', action='store_true',
+        help="don't take global shortcuts (they need X)",
+    )
+    parser.add_argument(
+        '--quit-when-ready', action='store_true', help=argparse.SUPPRESS,
+    )
+    args, qt_args = parser.parse_known_args()
+    app = Application(sys.argv[:1] + qt_args)
+
+    if args.trace:
+        TRACE.configure(args.trace)
+    if args.trace_ring:
+        def dump_trace(signum=None, frame=None):
+            with open(args.trace_ring, 'wb') as f:
+                TRACE.dump(f)
+        TRACE.use_ring()
+        signal.signal(signal.SIGUSR1, dump_trace)
+        app.aboutToQuit.connect(dump_trace)
+
+    renderer = None
+    if args.render_thread:
+        TILE_IMAGES = True
+        renderer = ThreadedRenderer()
+    overlay_widget = make_overlay_widget(renderer)
+    if args.record_input:
+        overlay_widget.input_log = open(args.record_input, 'a', buffering=1)
+    if args.resident_pictures is not None:
+        overlay_widget.resident_pictures = args.resident_pictures
+    if args.final_cache is not None:
+        overlay_widget.final_cache.max_bytes = args.final_cache * 2**20
+    if args.raster_cache is not None:
+        overlay_widget.raster_cache.max_bytes = args.raster_cache * 2**20
+    if args.predict is not None:
+        overlay_widget.predict_seconds = args.predict / 1000
+    if args.record:
+        overlay_widget.recorder = Recorder(args.record, overlay_widget.size())
+        app.aboutToQuit.connect(overlay_widget.recorder.close)
+    if args.session:
+        session = open_session(overlay_widget, args.session)
+        app.aboutToQuit.connect(session.close)
+    if args.broadcast:
+        broadcaster = Broadcaster(overlay_widget, args.broadcast)
+        app.aboutToQuit.connect(broadcaster.close)
 
     toolbox = make_toolbox_window(overlay_widget)
-    toolbox.show()
-    toolbox.move(overlay_widget.geometry().topLeft())
-
     app._toolbox = toolbox
 
-    threading.Thread(
-        target=watch_shortcuts,
-        args=(app, overlay_widget, ),
-        daemon=True
-    ).start()
+    if not args.no_shortcuts:
+        app._shortcut_notifier = watch_shortcuts(
+            app, toolbox.shortcut_to_action,
+        )
+
+    # Drawing can start once the event loop runs. The toolbox is shown
+    # in a later pass, and fills in its history in the one after that.
+    def ready():
+        if args.quit_when_ready:
+            print('overlay', flush=True)
+        QTimer.singleShot(0, show_toolbox)
+    def show_toolbox():
+        toolbox.show_with_history()
+        toolbox.move(overlay_widget.pen_screen.geometry().topLeft())
+        if args.quit_when_ready:
+            QTimer.singleShot(0, toolbox_ready)
+    def toolbox_ready():
+        print('toolbox', flush=True)
+        app.exit()
+    QTimer.singleShot(0, ready)
 
     sys.exit(app.exec())
 
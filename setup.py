@@ -16,10 +16,15 @@ setup (
     python_modules=["pointout"],
     install_requires=[
         'pyside6',
+        'numpy',
     ],
     entry_points = {
         'console_scripts': [
             'pointout=pointout:main',
+            'pointout-bench=pointout:bench_main',
+            'pointout-trace=pointout:trace_main',
+            'pointout-export=pointout:export_main',
+            'pointout-view=pointout:view_main',
         ],
     }
 )